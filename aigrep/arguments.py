@@ -1,5 +1,7 @@
-from argparse import ArgumentParser, Namespace
-from typing import List
+from argparse import ArgumentParser, Namespace, BooleanOptionalAction
+from typing import List, Type
+
+from aigrep.cache import DEFAULT_CACHE_DIR, DEFAULT_CACHE_MAX_SIZE, DEFAULT_CACHE_MAX_AGE
 
 DEFAULT_CONFIG_PATH = '~/.aigrep/config.toml'
 
@@ -16,6 +18,9 @@ Do NOT refer to your knowledge cut-off date.'''
 DEFAULT_FORMAT = '#AIGREP:%s'
 
 
+DEFAULT_SOCKET_PATH = '~/.aigrep/daemon.sock'
+
+
 class ArgsNamespace(Namespace):
     verbose: int
     config: str
@@ -23,33 +28,78 @@ class ArgsNamespace(Namespace):
     write: bool
     json: bool
     format: str
+    unordered: bool
+    reorder_window: int
+    schedule: str
+    lookahead: int
 
     model: str
+    cascade: List[str]
+    escalate: str
     test: bool
     dry: bool
     budget: int
     abort: int
     parallel: int
+    adaptive: bool
+    min_parallel: int
+    timeout: float
+    connect_timeout: float
+    read_timeout: float
+    retries: int
+    hedge: bool
 
     system: str
     system_file: str
     window: int
     max_tokens: int
     temperature: float
+    pack: int
+    dedup: bool
+    reduce: bool
+    reduce_system: str
 
     validate: str
     regexp: str
     attempts: int
     number: int
+    race: str
 
     encoding: str
     chunk: int
     overlap: int
+    workers: int
+    pool: str
+
+    include_regexp: List[str]
+    exclude_regexp: List[str]
+    keyword: List[str]
+    keywords_file: str
+    ignore_case: bool
+    max_line_length: int
+    skip_binary: bool
+    skip_minified: bool
 
     recursive: bool
     follow: bool
     exclude: List[str]
 
+    cache: bool
+    cache_dir: str
+    cache_size: int
+    cache_age: float
+    incremental: str
+    journal: str
+    resume: bool
+
+    metrics: bool
+    prometheus: str
+    prometheus_interval: float
+
+    serve: bool
+    client: bool
+    socket: str
+
     paths: List[str]
 
     @classmethod
@@ -57,8 +107,8 @@ class ArgsNamespace(Namespace):
         return cls(**vars(ns))
 
 
-def create_argument_parser():
-    parser = ArgumentParser()
+def create_argument_parser(parser_class: Type[ArgumentParser] = ArgumentParser):
+    parser = parser_class()
 
     g = parser.add_argument_group('Configuration')
     g.add_argument('--verbose', '-v', action='count', default=0, help='Verbose output (-vv for debug)')
@@ -67,14 +117,27 @@ def create_argument_parser():
     g.add_argument('--write', '-W', action='store_true', help='Write the default configuration and exit (does not overwrite)')
     g.add_argument('--json', '-J', action='store_true', help='Produce only machine parseable JSONL output')
     g.add_argument('--format', '-F', default=DEFAULT_FORMAT, help='Python format string for the verbose output lines')
+    g.add_argument('--unordered', '-U', action='store_true', help='Print the results as soon as they are available, not in the order of the chunks (use with --json)')
+    g.add_argument('--reorder-window', type=int, help='Maximum number of chunks in progress ahead of the next one to print (default is 16 times the parallel generations)')
+    g.add_argument('--schedule', choices=('fifo', 'longest', 'shortest'), default='fifo', help='Order of dispatching the chunks to the LLM: in input order, the longest or the shortest first (does not change the order of the outputs)')
+    g.add_argument('--lookahead', type=int, help='Maximum number of chunks waiting to be dispatched, the next one is chosen from those (default is the parallel generations, 8 times that for longest and shortest)')
 
     g = parser.add_argument_group('Language model')
     g.add_argument('--model', '-m', help='ID of the model to use (defaults to the first one configured)')
+    g.add_argument('--cascade', nargs='*', metavar='ID', help='Send each chunk to the first model, escalate it to the next one if its outputs are not valid (defaults to all the models configured, in order)')
+    g.add_argument('--escalate', metavar='REGEXP', help='Python regexp finding outputs not confident enough, escalated to the next model of the cascade (accepted from the last one)')
     g.add_argument('--test', '-t', action='store_true', help='Test LLM access and exit')
     g.add_argument('--dry', '-y', action='store_true', help='Dry run (do not use the LLM, provide UNDEFINED results)')
     g.add_argument('--budget', '-B', type=int, help='Maximum tokens to use in total')
     g.add_argument('--abort', '-A', type=int, help='Abort after producing this many outputs')
     g.add_argument('--parallel', '-P', type=int, help='Maximum number of parallel generations (overrides model config)')
+    g.add_argument('--adaptive', action='store_true', help='Tune the number of parallel generations based on the latency and errors observed')
+    g.add_argument('--min-parallel', type=int, default=1, help='Minimum number of parallel generations with --adaptive')
+    g.add_argument('--timeout', type=float, help='Seconds to wait for a generation before retrying it (overrides model config, 0: no limit)')
+    g.add_argument('--connect-timeout', type=float, help='Seconds to wait for connecting to a server (overrides model config, 0: no limit)')
+    g.add_argument('--read-timeout', type=float, help='Seconds to wait for each read of a response (overrides model config, 0: no limit)')
+    g.add_argument('--retries', type=int, help='Retries of generations failed due to connection errors, timeouts or server errors, after an exponential backoff (overrides model config)')
+    g.add_argument('--hedge', action=BooleanOptionalAction, help='Start a duplicate of generations running longer than 95%% of the recent ones, use the one finishing first (overrides model config)')
 
     g = parser.add_argument_group('Prompt and generation')
     g.add_argument('--system', '-s', default=DEFAULT_SYSTEM, help="System prompt (the default one summarizes the text)")
@@ -82,23 +145,61 @@ def create_argument_parser():
     g.add_argument('--window', '-w', type=int, help='Context window size (overrides model config)')
     g.add_argument('--max-tokens', '-M', type=int, help='Maximum tokens to generate (overrides calculated default)')
     g.add_argument('--temperature', '-T', type=float, help='Temperature (overrides model config)')
+    g.add_argument('--dedup', action=BooleanOptionalAction, default=True, help='Generate identical chunks only once, reuse the result for the duplicates')
+    g.add_argument('--pack', type=int, default=0, help='Pack up to this many small chunks into a single generation, each of them is answered separately')
+    g.add_argument('--reduce', '-R', action='store_true', help='Reduce the outputs of all chunks into a single answer by a tree of generations (map-reduce)')
+    g.add_argument('--reduce-system', help='System prompt of the reduce generations (the default one combines the partial answers according to the system prompt)')
 
     g = parser.add_argument_group('Validation and retries')
     g.add_argument('--validate', '-V', help='Validate the output of the LLM: json, yaml, toml, csv (keeps the first valid output)')
     g.add_argument('--regexp', '-e', help='Python regexp to validate LLM output (keeps the first matching output)')
     g.add_argument('--attempts', '-a', type=int, default=1, help='Maximum number of generation attempts to get a valid result (multiplied by --multi)')
     g.add_argument('--number', '-n', type=int, default=1, help='Number of generations per attempt (useful with --regexp)')
+    g.add_argument('--race', choices=('first', 'ordered'), help='Generate the samples as separate concurrent requests, keep the first valid one and cancel the rest (ordered: the valid one started first, deterministic)')
 
     g = parser.add_argument_group('Reading and chunking text')
     g.add_argument('--encoding', '-E', default='utf-8', help='Character encoding of all the files')
     g.add_argument('--chunk', '-k', type=int, help='Text chunk size in tokens (default is third of the context size)')
-    g.add_argument('--overlap', '-l', type=int, default=0, help='Text chunk overlap in tokens (approximate)')
+    g.add_argument('--overlap', '-l', type=int, default=0, help='Text chunk overlap in tokens (whole lines up to this size)')
+    g.add_argument('--workers', type=int, default=2, help='Number of workers reading and chunking files ahead of the generations')
+    g.add_argument('--pool', choices=('thread', 'process'), default='thread', help='Run the reading and chunking workers in threads or processes')
+
+    g = parser.add_argument_group('Pre-filter (chunks skipped are not sent to the LLM)')
+    g.add_argument('--include-regexp', action='append', metavar='REGEXP', help='Process only the chunks matching any of these Python regexps (can be repeated)')
+    g.add_argument('--exclude-regexp', action='append', metavar='REGEXP', help='Skip the chunks matching any of these Python regexps (can be repeated)')
+    g.add_argument('--keyword', action='append', help='Process only the chunks containing any of these keywords (can be repeated)')
+    g.add_argument('--keywords-file', help='Load further keywords from this file, one per line')
+    g.add_argument('--ignore-case', action='store_true', help='Case insensitive regexp and keyword matching')
+    g.add_argument('--max-line-length', type=int, default=0, help='Skip the chunks with lines longer than this many characters (0: no limit)')
+    g.add_argument('--skip-binary', action=BooleanOptionalAction, default=True, help='Skip the files containing NUL bytes in their first 64kB')
+    g.add_argument('--skip-minified', action=BooleanOptionalAction, default=False, help='Skip the files looking minified (very long lines on average in their first 64kB)')
 
     g = parser.add_argument_group('Filesystem traversal')
     g.add_argument('--recursive', '-r', action='store_true', help='Recursive directory traversal')
     g.add_argument('--follow', '-L', action='store_true', help='Follow symlinks')
     g.add_argument('--exclude', '-X', nargs='*', help='Exclude files matching any of these glob patterns (can be multiple)')
 
+    g = parser.add_argument_group('Result cache')
+    g.add_argument('--cache', action=BooleanOptionalAction, default=False, help='Reuse the results of earlier runs for identical chunks and settings')
+    g.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help='Folder to keep the result cache in')
+    g.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_MAX_SIZE, help='Maximum size of the result cache in MB (least recently used results are evicted)')
+    g.add_argument('--cache-age', type=float, default=DEFAULT_CACHE_MAX_AGE, help='Maximum age of cached results in days')
+    g.add_argument('--incremental', '-I', metavar='MANIFEST', help='Process only the files changed since the run which wrote this manifest file, replay the rest')
+
+    g = parser.add_argument_group('Checkpoint')
+    g.add_argument('--journal', metavar='PATH', help='Append each chunk completed to this journal file, so an interrupted run can be resumed')
+    g.add_argument('--resume', action='store_true', help='Skip the chunks already completed according to the journal and continue where the previous run stopped')
+
+    g = parser.add_argument_group('Metrics')
+    g.add_argument('--metrics', action='store_true', help='Log a METRICS event with the time spent in each stage, token throughput, queue depths and concurrency at exit')
+    g.add_argument('--prometheus', metavar='PATH', help='Write the metrics to this Prometheus textfile periodically while running')
+    g.add_argument('--prometheus-interval', type=float, default=15, help='Seconds between updates of the Prometheus textfile')
+
+    g = parser.add_argument_group('Daemon')
+    g.add_argument('--serve', action='store_true', help='Run as a daemon keeping the models, tokenizers and the cache warm, serving the jobs of the clients with a fair share of the parallel generations')
+    g.add_argument('--client', action='store_true', help='Submit the job to the daemon and print its results')
+    g.add_argument('--socket', default=DEFAULT_SOCKET_PATH, help='Unix socket of the daemon')
+
     parser.add_argument('paths', metavar='PATHS', nargs='*', help="Files or folders to process, can contain glob patterns (stdin if none given)")
 
     return parser
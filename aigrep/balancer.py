@@ -0,0 +1,204 @@
+""" Load balancing generations over multiple endpoints
+
+Each generation is routed to the healthy endpoint with the fewest
+outstanding tokens, then the fewest outstanding requests.
+
+Endpoints failing to respond are taken out of rotation for a while
+(passive health checking), the generation in flight is retried on
+another endpoint (failover). Once all endpoints failed the generation
+is retried after an exponential backoff with jitter.
+
+Optionally a generation running longer than the 95th percentile of the
+latencies observed is hedged: a duplicate is started, preferably on
+another endpoint, the first one to finish wins and the other is cancelled.
+
+"""
+import asyncio
+import random
+import time
+from collections import deque
+from typing import List, Optional, Set, Deque, AbstractSet
+
+import aiohttp
+from vllm_client.sampling_params import SamplingParams
+
+from aigrep.providers import Provider, Completion
+
+# Seconds to keep a failed endpoint out of rotation, doubled on each subsequent failure
+MIN_COOLDOWN = 1.0
+MAX_COOLDOWN = 60.0
+
+# Seconds to wait before retrying a failed generation, the upper limit is doubled on each retry
+MIN_BACKOFF = 0.5
+MAX_BACKOFF = 30.0
+
+# Number of recent latencies to calculate the hedging delay from, minimum number of them needed
+LATENCY_WINDOW = 1000
+MIN_LATENCY_SAMPLES = 20
+
+
+class Endpoint:
+
+    def __init__(self, provider: Provider, limit: int):
+        self.provider: Provider = provider
+        self.address: str = provider.address
+        self.limit: int = limit
+
+        # Outstanding generations
+        self.requests: int = 0
+        self.tokens: int = 0
+
+        # Health
+        self.failures: int = 0
+        self.down_until: float = 0.0
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.down_until
+
+    @property
+    def available(self) -> bool:
+        return self.healthy and (not self.limit or self.requests < self.limit)
+
+    def mark_down(self):
+        # Generations failing concurrently count as a single failure
+        if not self.healthy:
+            return
+
+        self.failures += 1
+        self.down_until = time.monotonic() + min(MAX_COOLDOWN, MIN_COOLDOWN * 2 ** (self.failures - 1))
+
+    def mark_up(self):
+        self.failures = 0
+        self.down_until = 0.0
+
+
+class Balancer:
+
+    def __init__(self, providers: List[Provider], limit: int = 0, timeout: float = 0.0, retries: int = 0, hedge: bool = False):
+        assert providers, 'No endpoint addresses'
+        assert limit >= 0, f'Invalid endpoint parallelism: {limit}'
+        assert timeout >= 0.0, f'Invalid timeout: {timeout}'
+        assert retries >= 0, f'Invalid number of retries: {retries}'
+
+        self.endpoints: List[Endpoint] = [Endpoint(provider, limit) for provider in providers]
+        self.condition = asyncio.Condition()
+
+        self.timeout: float = timeout
+        self.retries: int = retries
+        self.hedge: bool = hedge
+
+        # Latencies of recent successful generations and the 95th percentile calculated from them
+        self.latencies: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self.latency_count: int = 0
+        self.latency_p95: Optional[float] = None
+
+        self.retry_count: int = 0
+        self.hedge_count: int = 0
+        self.hedge_wins: int = 0
+
+    async def generate(self, prompt: str, params: SamplingParams, tokens: int) -> Completion:
+        delay = self.latency_p95 if self.hedge else None
+        if delay is None:
+            return await self.generate_with_retries(prompt, params, tokens, set())
+
+        busy: Set[Endpoint] = set()
+        first = asyncio.create_task(self.generate_with_retries(prompt, params, tokens, busy))
+        try:
+            done, _ = await asyncio.wait([first], timeout=delay)
+            if done:
+                return first.result()
+
+            # Slow generation, start a duplicate preferably on another endpoint
+            self.hedge_count += 1
+            second = asyncio.create_task(self.generate_with_retries(prompt, params, tokens, set(), avoid=busy))
+            try:
+                pending = {first, second}
+                while 1:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        if task.exception() is None or not pending:
+                            if task is second and task.exception() is None:
+                                self.hedge_wins += 1
+                            return task.result()
+            finally:
+                second.cancel()
+        finally:
+            first.cancel()
+
+    async def generate_with_retries(self,
+                                    prompt: str,
+                                    params: SamplingParams,
+                                    tokens: int,
+                                    busy: Set[Endpoint],
+                                    avoid: AbstractSet[Endpoint] = frozenset()) -> Completion:
+        failed: Set[Endpoint] = set()
+        retry = 0
+        while 1:
+            endpoint = await self.acquire(tokens, failed, avoid)
+            busy.add(endpoint)
+            started = time.monotonic()
+            try:
+                generation = endpoint.provider.generate(prompt, params)
+                completion: Completion = await (asyncio.wait_for(generation, self.timeout) if self.timeout else generation)
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                if isinstance(e, aiohttp.ClientResponseError) and e.status < 500:
+                    raise
+
+                endpoint.mark_down()
+                failed.add(endpoint)
+
+                # Fail over to the other endpoints, back off and retry if all of them failed
+                if len(failed) == len(self.endpoints):
+                    if retry >= self.retries:
+                        raise
+                    retry += 1
+                    self.retry_count += 1
+                    failed.clear()
+                    await asyncio.sleep(random.uniform(0.0, min(MAX_BACKOFF, MIN_BACKOFF * 2 ** retry)))
+            else:
+                endpoint.mark_up()
+                self.observe_latency(time.monotonic() - started)
+                return completion
+            finally:
+                busy.discard(endpoint)
+                await self.release(endpoint, tokens)
+
+    def observe_latency(self, latency: float):
+        self.latencies.append(latency)
+        self.latency_count += 1
+
+        # Recalculated only periodically to keep the overhead low
+        if self.latency_count % MIN_LATENCY_SAMPLES == 0:
+            ordered = sorted(self.latencies)
+            self.latency_p95 = ordered[int(0.95 * (len(ordered) - 1))]
+
+    async def acquire(self, tokens: int, failed: Set[Endpoint], avoid: AbstractSet[Endpoint] = frozenset()) -> Endpoint:
+        async with self.condition:
+            while 1:
+                endpoint = self.select(failed, avoid)
+                if endpoint is not None:
+                    endpoint.requests += 1
+                    endpoint.tokens += tokens
+                    return endpoint
+
+                # Wait for a generation to finish or an endpoint to recover
+                recoveries = [e.down_until for e in self.endpoints if not e.healthy]
+                timeout = max(0.0, min(recoveries) - time.monotonic()) if recoveries else None
+                try:
+                    await asyncio.wait_for(self.condition.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+    def select(self, failed: Set[Endpoint], avoid: AbstractSet[Endpoint]) -> Optional[Endpoint]:
+        candidates = [e for e in self.endpoints if e.available and e not in failed]
+        if not candidates:
+            return None
+
+        return min(candidates, key=lambda e: (e in avoid, e.tokens, e.requests))
+
+    async def release(self, endpoint: Endpoint, tokens: int):
+        async with self.condition:
+            endpoint.requests -= 1
+            endpoint.tokens -= tokens
+            self.condition.notify_all()
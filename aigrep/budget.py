@@ -0,0 +1,46 @@
+""" Token budget with reservations
+
+The estimated cost of each generation (the prompt and the maximum number
+of tokens to generate) is reserved before it is started, then settled with
+the actual cost once finished. Generations wait while the reservations in
+flight do not leave room for them and are refused once the tokens spent do
+not leave room for them, so parallel generations cannot overshoot the budget.
+Generations cancelled after being sent are charged their whole reservation.
+
+"""
+import asyncio
+from typing import Optional
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+class Budget:
+
+    def __init__(self, limit: Optional[int] = None):
+        assert limit is None or limit > 0, f'Invalid budget: {limit}'
+        self.limit: Optional[int] = limit
+        self.spent: int = 0
+        self.reserved: int = 0
+        self.refused: int = 0
+        self.condition = asyncio.Condition()
+
+    async def reserve(self, tokens: int) -> bool:
+        async with self.condition:
+            while self.limit is not None and self.spent + self.reserved + tokens > self.limit:
+                if self.spent + tokens > self.limit:
+                    self.refused += 1
+                    return False
+
+                # Wait for the generations in flight to settle their reservations
+                await self.condition.wait()
+
+            self.reserved += tokens
+            return True
+
+    async def settle(self, reserved: int, tokens: int):
+        async with self.condition:
+            self.reserved -= reserved
+            self.spent += tokens
+            self.condition.notify_all()
@@ -0,0 +1,118 @@
+""" Persistent result cache
+
+Content addressed, the key is a hash of everything which affects the
+result of a chunk: model, prompt template, system prompt, chunk text,
+sampling parameters and validation settings.
+
+Only successful results are cached, so failed chunks are retried on the next run.
+
+"""
+import hashlib
+import json
+import os
+import time
+from typing import Optional, Tuple, Any, Dict
+
+DEFAULT_CACHE_DIR = '~/.aigrep/cache'
+DEFAULT_CACHE_MAX_SIZE = 1024  # MB
+DEFAULT_CACHE_MAX_AGE = 30  # days
+
+# Number of access times of cache hits to update in a single transaction
+ACCESS_BATCH_SIZE = 256
+
+SCHEMA = '''\
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    output TEXT NOT NULL,
+    cost INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed);
+'''
+
+
+def cache_key(*parts: Any) -> str:
+    data = json.dumps(parts, sort_keys=True, default=repr, ensure_ascii=False)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+
+    def __init__(self, folder: str = DEFAULT_CACHE_DIR, max_size: int = DEFAULT_CACHE_MAX_SIZE, max_age: float = DEFAULT_CACHE_MAX_AGE):
+        assert max_size > 0, f'Invalid cache size: {max_size}'
+        assert max_age > 0, f'Invalid cache age: {max_age}'
+
+        self.folder: str = os.path.expanduser(folder)
+        self.max_size: int = max_size * 1024 * 1024
+        self.max_age: float = max_age * 86400
+
+        self.hits: int = 0
+        self.misses: int = 0
+
+        # Access times of the hits not written yet, so hits do not wait for a commit each
+        self.accessed: Dict[str, float] = {}
+
+        # Imported only when used, the defaults above are imported by the argument parser
+        import sqlite3
+
+        os.makedirs(self.folder, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(self.folder, 'results.sqlite'))
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        if self.db is None:
+            return
+
+        self.flush_accessed()
+        self.evict()
+        self.db.close()
+        self.db = None
+
+    def get(self, key: str) -> Optional[Tuple[str, int]]:
+        row = self.db.execute('SELECT output, cost FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.accessed[key] = time.time()
+        if len(self.accessed) >= ACCESS_BATCH_SIZE:
+            self.flush_accessed()
+
+        return row[0], row[1]
+
+    def flush_accessed(self):
+        if not self.accessed:
+            return
+
+        with self.db:
+            self.db.executemany('UPDATE results SET accessed = ? WHERE key = ?', [(t, key) for key, t in self.accessed.items()])
+        self.accessed.clear()
+
+    def put(self, key: str, output: str, cost: int):
+        now = time.time()
+        size = len(key) + len(output.encode('utf-8'))
+        with self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO results (key, output, cost, size, created, accessed) VALUES (?, ?, ?, ?, ?, ?)',
+                (key, output, cost, size, now, now))
+
+    def evict(self):
+        with self.db:
+            self.db.execute('DELETE FROM results WHERE created < ?', (time.time() - self.max_age,))
+
+            total: int = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+            if total <= self.max_size:
+                return
+
+            # Least recently used first
+            keys = []
+            for key, size in self.db.execute('SELECT key, size FROM results ORDER BY accessed'):
+                if total <= self.max_size:
+                    break
+                keys.append((key,))
+                total -= size
+
+            self.db.executemany('DELETE FROM results WHERE key = ?', keys)
@@ -0,0 +1,348 @@
+""" Reading and chunking files
+
+These functions run in a worker pool (threads or processes),
+so they must not depend on the state of the processor.
+
+Files and streams are read in segments of a single block of text, so only
+the chunks of a segment are held in memory instead of all chunks of a huge
+file. Each segment returns the position to continue from: the lines carried
+over to the next block and where the file was left (a cookie of the text
+file, so files can be continued in another worker process) or the stream
+itself (streams are continued in the same thread pool).
+
+"""
+import hashlib
+import io
+import os
+import time
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass, field
+from functools import wraps
+from itertools import accumulate
+from typing import List, TextIO, Tuple, Iterator, Optional, Callable, Union, BinaryIO
+
+from aigrep.prefilter import Prefilter, HEAD_SIZE
+from aigrep.tokenizer import Tokenizer, load_tokenizer
+from aigrep.utils import file_digest
+
+# Number of characters to tokenize at once, read in each segment
+BLOCK_SIZE = 1 << 20
+
+
+@dataclass
+class Source:
+    """ Input not read from a file: text, bytes or an open text or binary stream """
+    name: str
+    data: Union[str, bytes, TextIO, BinaryIO]
+
+
+@dataclass
+class Position:
+    """ Where to continue reading in the next segment """
+    # Line number of the first line carried over, the lines carried over and the end of the last chunk within them
+    lineno: int = 1
+    lines: List[str] = field(default_factory=list)
+    end: int = 0
+
+    # Position in the text file after the segment (TextIOWrapper.tell), files only
+    cookie: int = 0
+
+    # Stream to continue reading, streams only (not picklable)
+    stream: Optional[TextIO] = None
+
+
+@dataclass
+class FileChunks:
+    path: str
+    # Line number, text and number of tokens of each chunk
+    chunks: List[Tuple[int, str, int]] = field(default_factory=list)
+
+    # Line number, number of lines and the reason of each chunk skipped by the prefilter
+    skipped: List[Tuple[int, int, str]] = field(default_factory=list)
+
+    # Empty if the file was read successfully, otherwise the event to log
+    error: str = ''
+
+    # File information for the incremental manifest, collected only on request
+    size: int = 0
+    mtime: float = 0.0
+    digest: str = ''
+
+    # Time spent on reading and chunking the file
+    seconds: float = 0.0
+
+    # Read from stdin or a source, not a file
+    stream: bool = False
+
+    # Where to continue reading the next segment from, None after the last segment
+    position: Optional[Position] = None
+
+
+def timed(func: Callable[..., FileChunks]) -> Callable[..., FileChunks]:
+    @wraps(func)
+    def wrapper(*args, **kws) -> FileChunks:
+        started = time.perf_counter()
+        result = func(*args, **kws)
+        result.seconds = time.perf_counter() - started
+        return result
+
+    return wrapper
+
+
+class HashingReader(io.RawIOBase):
+    """ Calculates the content hash while the file is read
+    """
+
+    def __init__(self, raw: io.RawIOBase):
+        super().__init__()
+        self.raw: io.RawIOBase = raw
+        self.hash = hashlib.sha256()
+
+    def readable(self) -> bool:
+        return True
+
+    # Telling the position is needed by TextIOWrapper.tell(), seeking would break the hash
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.raw.tell()
+
+    def readinto(self, buffer) -> int:
+        size = self.raw.readinto(buffer)
+        if size:
+            self.hash.update(memoryview(buffer)[:size])
+        return size
+
+    def close(self):
+        self.raw.close()
+        super().close()
+
+
+class StreamReader(io.RawIOBase):
+    """ Reads a binary stream of the caller without closing it
+    """
+
+    def __init__(self, stream: BinaryIO):
+        super().__init__()
+        self.read_stream: Callable[[int], bytes] = getattr(stream, 'read1', stream.read)
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = self.read_stream(len(buffer))
+        size = len(data)
+        buffer[:size] = data
+        return size
+
+
+@timed
+def chunk_file(path: str,
+               tokenizer: str,
+               encoding: str,
+               chunk_size: int,
+               chunk_overlap: int,
+               digest: bool = False,
+               prefilter: Optional[Prefilter] = None,
+               name: str = '',
+               position: Optional[Position] = None) -> FileChunks:
+    """ Reads the next segment of the file, the first one without a position """
+    # Reported by its name if given, the path may be resolved from another directory
+    result = FileChunks(name or path)
+
+    try:
+        raw = open(path, 'rb', buffering=0)
+    except OSError:
+        result.error = 'SKIP_NO_ACCESS'
+        return result
+
+    hashing_reader: Optional[HashingReader] = None
+    if digest and position is None:
+        st = os.fstat(raw.fileno())
+        result.size = st.st_size
+        result.mtime = st.st_mtime
+        raw = hashing_reader = HashingReader(raw)
+
+    buffered = io.BufferedReader(raw, HEAD_SIZE)
+    if prefilter is not None and position is None:
+        result.error = prefilter.check_head(buffered.peek(HEAD_SIZE)[:HEAD_SIZE])
+        if result.error:
+            buffered.close()
+            return result
+
+    with io.TextIOWrapper(buffered, encoding=encoding) as f:
+        try:
+            if position is None:
+                position = Position()
+            else:
+                f.seek(position.cookie)
+            if not chunk_segment(result, f, load_tokenizer(tokenizer), chunk_size, chunk_overlap, prefilter, position):
+                position.cookie = f.tell()
+                result.position = position
+                return result
+        except UnicodeDecodeError:
+            result.error = 'FAILED_TO_DECODE'
+            return result
+
+    # The whole file is hashed while reading only if it fits into a single segment
+    if hashing_reader is not None:
+        result.digest = hashing_reader.hash.hexdigest()
+    elif digest:
+        result.digest = file_digest(path)
+
+    return result
+
+
+@timed
+def chunk_stream(f: TextIO,
+                 tokenizer: str,
+                 chunk_size: int,
+                 chunk_overlap: int,
+                 prefilter: Optional[Prefilter] = None,
+                 name: str = '-',
+                 position: Optional[Position] = None) -> FileChunks:
+    """ Reads the next segment of the stream, the first one without a position """
+    result = FileChunks(name, stream=True)
+
+    if position is None:
+        position = Position(stream=f)
+
+    try:
+        if not chunk_segment(result, f, load_tokenizer(tokenizer), chunk_size, chunk_overlap, prefilter, position):
+            result.position = position
+    except UnicodeDecodeError:
+        result.error = 'FAILED_TO_DECODE'
+
+    return result
+
+
+def chunk_source(source: Source, tokenizer: str, encoding: str, chunk_size: int, chunk_overlap: int, prefilter: Optional[Prefilter] = None) -> FileChunks:
+    """ Reads the first segment of the source, the rest are read by chunk_stream """
+    data = source.data
+
+    if isinstance(data, str):
+        return chunk_stream(io.StringIO(data), tokenizer, chunk_size, chunk_overlap, prefilter, source.name)
+
+    if isinstance(data, bytes):
+        if prefilter is not None:
+            error = prefilter.check_head(data[:HEAD_SIZE])
+            if error:
+                return FileChunks(source.name, error=error, stream=True)
+        f = io.TextIOWrapper(io.BytesIO(data), encoding=encoding)
+    elif isinstance(data, io.TextIOBase):
+        f = data
+    else:
+        # Binary stream, it is left open for the caller
+        f = io.TextIOWrapper(io.BufferedReader(StreamReader(data)), encoding=encoding)
+
+    return chunk_stream(f, tokenizer, chunk_size, chunk_overlap, prefilter, source.name)
+
+
+def chunk_segment(result: FileChunks,
+                  f: TextIO,
+                  tokenizer: Tokenizer,
+                  chunk_size: int,
+                  chunk_overlap: int,
+                  prefilter: Optional[Prefilter],
+                  position: Position) -> bool:
+    """ Chunks the next block of text, returns whether it was the last one """
+    block, final = read_block(f)
+    filter_chunks(result, iter_chunks(block, final, tokenizer, chunk_size, chunk_overlap, position), prefilter)
+    return final
+
+
+def filter_chunks(result: FileChunks, chunks: Iterator[Tuple[int, str, int]], prefilter: Optional[Prefilter]):
+    if prefilter is None:
+        result.chunks.extend(chunks)
+        return
+
+    for chunk in chunks:
+        lineno, text, tokens = chunk
+        reason = prefilter.check(text)
+        if reason:
+            result.skipped.append((lineno, text.count('\n'), reason))
+        else:
+            result.chunks.append(chunk)
+
+
+def iter_chunks(block: List[str], final: bool, tokenizer: Tokenizer, chunk_size: int, chunk_overlap: int, position: Position) -> Iterator[Tuple[int, str, int]]:
+    """ Cuts chunks at line boundaries based on token offsets
+
+    Each block of text is tokenized only once. The lines not consumed
+    by the end of a block (including the overlap) are carried over to the next one in the position.
+    Lines longer than the chunk size are split at token boundaries.
+    """
+    lines = position.lines
+    lineno = position.lineno
+
+    # End of the last chunk yielded, relative to the first line kept
+    end = position.end
+
+    lines.extend(block)
+    text = ''.join(lines)
+
+    # Character offset of the start of each line and the end of the last one
+    starts = list(accumulate((len(line) for line in lines), initial=0))
+
+    # Index of the first token starting in each line (token count up to the line)
+    offsets = tokenizer.token_offsets(text)
+    bounds = [bisect_left(offsets, start) for start in starts]
+
+    count = len(lines)
+    i = 0
+    while i < count:
+        # Most lines starting from line i which fit into the chunk
+        j = bisect_right(bounds, bounds[i] + chunk_size, i) - 1
+        if j == count and not final:
+            break
+
+        if j == i:
+            yield from split_line(text, lineno + i, starts[i], starts[i + 1], offsets[bounds[i]:bounds[i + 1]], chunk_size)
+            i += 1
+            end = i
+            continue
+
+        if j <= end:
+            # Nothing would be added to the overlap
+            i = end
+            continue
+
+        chunk = text[starts[i]:starts[j]]
+        if chunk.strip():
+            yield lineno + i, chunk, bounds[j] - bounds[i]
+        end = j
+
+        if chunk_overlap:
+            i = max(i + 1, bisect_left(bounds, bounds[j] - chunk_overlap, i, j))
+        else:
+            i = j
+
+    del lines[:i]
+    position.lineno = lineno + i
+    position.end = max(0, end - i)
+
+
+def split_line(text: str, lineno: int, start: int, stop: int, offsets: List[int], chunk_size: int) -> Iterator[Tuple[int, str, int]]:
+    for k in range(0, len(offsets), chunk_size):
+        a = start if k == 0 else offsets[k]
+        b = offsets[k + chunk_size] if k + chunk_size < len(offsets) else stop
+        piece = text[a:b]
+        if piece.strip():
+            yield lineno, piece, min(chunk_size, len(offsets) - k)
+
+
+def read_block(f: TextIO) -> Tuple[List[str], bool]:
+    """ Reads whole lines up to the block size, returns them and whether the end was reached """
+    block: List[str] = []
+    size = 0
+
+    # Not iterating over the file, which would disable its tell()
+    while size < BLOCK_SIZE:
+        line = f.readline()
+        if not line:
+            return block, True
+        block.append(line)
+        size += len(line)
+
+    return block, False
@@ -1,14 +1,14 @@
 #!/usr/bin/python3
-import asyncio
 import os.path
 import sys
 from argparse import Namespace
-from typing import Tuple
+from typing import Tuple, Dict, List
 
 from aigrep.config import Config, DEFAULT_CONFIG, ModelConfig
-from aigrep.model import Model
-from aigrep.processor import Processor
-from arguments import create_argument_parser, ArgsNamespace
+from aigrep.arguments import create_argument_parser, ArgsNamespace
+
+# The model client (aiohttp), the processor and asyncio are imported only when they are used,
+# so the help and the configuration commands start fast
 
 
 def load_config(args: ArgsNamespace) -> Tuple[str, Config]:
@@ -22,6 +22,8 @@ def load_config(args: ArgsNamespace) -> Tuple[str, Config]:
 
 
 def load_model(args, cfg: ModelConfig):
+    from aigrep.model import Model
+
     cfg = cfg.clone()
 
     if args.window is not None:
@@ -33,17 +35,33 @@ def load_model(args, cfg: ModelConfig):
     if args.temperature is not None:
         cfg.temperature = args.temperature
 
+    if args.timeout is not None:
+        cfg.timeout = args.timeout
+
+    if args.retries is not None:
+        cfg.retries = args.retries
+
+    if args.hedge is not None:
+        cfg.hedge = args.hedge
+
+    if args.connect_timeout is not None:
+        cfg.connect_timeout = args.connect_timeout
+
+    if args.read_timeout is not None:
+        cfg.read_timeout = args.read_timeout
+
     model = Model(cfg)
     return model
 
 
-async def run(args: ArgsNamespace):
+def configure(args: ArgsNamespace) -> bool:
+    """ Runs the configuration commands, returns True if there was one """
     path, config = load_config(args)
 
     if args.info:
         for cfg in config.models:
             print(cfg.id)
-        return
+        return True
 
     if args.write:
         if os.path.exists(path):
@@ -51,33 +69,79 @@ async def run(args: ArgsNamespace):
         else:
             DEFAULT_CONFIG.save(path)
             print(f'Wrote: {path}')
-        return
+        return True
+
+    return False
+
 
-    for cfg in config.models:
-        if args.model is None or cfg.id == args.model:
-            break
+def find_models(args: ArgsNamespace, config: Config) -> List[ModelConfig]:
+    """ Configurations of the models selected, raises ValueError if one is not configured """
+    cfgs: Dict[str, ModelConfig] = {cfg.id: cfg for cfg in config.models}
+    if args.cascade is not None:
+        ids = args.cascade or [cfg.id for cfg in config.models]
     else:
-        print(f'No model configured with ID: {args.model}')
-        sys.exit(1)
+        ids = [args.model or config.models[0].id] if config.models else [args.model]
+    for model_id in ids:
+        if model_id not in cfgs:
+            raise ValueError(f'No model configured with ID: {model_id}')
+    return [cfgs[model_id] for model_id in ids]
 
-    model = load_model(args, cfg)
 
-    if args.test:
-        if not await model.test():
-            print('FAILED')
-            sys.exit(1)
-        print('OK')
-        return
+async def run(args: ArgsNamespace):
+    from aigrep.processor import Processor
+
+    path, config = load_config(args)
+
+    try:
+        models = [load_model(args, cfg) for cfg in find_models(args, config)]
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
 
-    processor = Processor(args, config, model)
-    if not await processor.process():
+    try:
+        if args.test:
+            ok = await test_models(models)
+        else:
+            processor = Processor(args, config, models[0], models[1:])
+            ok = await processor.process()
+            # Written out before exiting, so a reader gone fails the run instead of the exit
+            processor.sink.flush()
+            ok = ok and not processor.sink.closed
+    finally:
+        for model in models:
+            await model.close()
+
+    if not ok:
         sys.exit(1)
 
 
+async def test_models(models: List) -> bool:
+    for model in models:
+        if not await model.test():
+            print(f'FAILED: {model.cfg.id}' if len(models) > 1 else 'FAILED')
+            return False
+    print('OK')
+    return True
+
+
 def main():
     argument_parser = create_argument_parser()
     ns: Namespace = argument_parser.parse_args()
     args: ArgsNamespace = ArgsNamespace.from_args(ns)
+
+    if configure(args):
+        return
+
+    if args.client:
+        from aigrep.client import run_client
+        sys.exit(run_client(args, sys.argv[1:]))
+
+    import asyncio
+    if args.serve:
+        from aigrep.daemon import serve
+        asyncio.run(serve(args))
+        return
+
     asyncio.run(run(args))
 
 
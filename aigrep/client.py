@@ -0,0 +1,88 @@
+""" Client of the daemon
+
+Submits the job given on the command line to the daemon over its Unix socket,
+then prints the results as they are streamed back, the same way the command
+line tool would. It does not import anything heavy, so it starts fast.
+
+The protocol is JSON lines. The request is a single line with the command line
+arguments, the working directory of the client and whether stdin follows.
+Stdin is sent as is after the request line. The daemon responds with the
+lines to print ({"out": text}), then the exit code ({"exit": code}).
+
+"""
+import json
+import os
+import socket
+import sys
+import threading
+from typing import List
+
+from aigrep.arguments import ArgsNamespace
+
+# Size of the blocks of stdin sent
+BLOCK_SIZE = 1 << 16
+
+
+def send_stdin(sock: socket.socket):
+    # Read from the file descriptor, the buffered stdin would be locked at exit if the job ends before the input
+    fd = sys.stdin.fileno()
+    try:
+        while 1:
+            data = os.read(fd, BLOCK_SIZE)
+            if not data:
+                break
+            sock.sendall(data)
+    except OSError:
+        pass
+    finally:
+        try:
+            sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+
+def discard_stdout():
+    # Points stdout to /dev/null, so what is left buffered does not fail at exit
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    os.close(devnull)
+
+
+def run_client(args: ArgsNamespace, argv: List[str]) -> int:
+    """ Runs the job on the daemon, returns the exit code """
+    path = os.path.expanduser(args.socket)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError as e:
+        print(f'Cannot connect to the daemon at {path}: {e}', file=sys.stderr)
+        return 1
+
+    # Stdin is processed only if no paths are given or one of them is -
+    stdin = not args.paths or '-' in args.paths
+    request = dict(argv=argv, cwd=os.getcwd(), stdin=stdin)
+    sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+
+    # Sent in the background, the results may arrive before all the input is sent
+    if stdin:
+        threading.Thread(target=send_stdin, args=(sock,), daemon=True).start()
+    else:
+        sock.shutdown(socket.SHUT_WR)
+
+    with sock, sock.makefile('rb') as f:
+        try:
+            for line in f:
+                message = json.loads(line)
+                if 'out' in message:
+                    print(message['out'])
+                elif 'exit' in message:
+                    # Written out before exiting, so a reader gone fails here instead of at the exit
+                    sys.stdout.flush()
+                    return message['exit']
+        except BrokenPipeError:
+            # The reader is gone (like head), as the command line tool: disconnecting stops the job
+            discard_stdout()
+            return 1
+
+    print('Connection to the daemon lost', file=sys.stderr)
+    return 1
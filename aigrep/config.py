@@ -2,8 +2,6 @@ import os
 from dataclasses import dataclass, asdict
 from typing import List, Union, Optional, Dict, Any
 
-import toml
-
 from aigrep.prompt_templates import MAPPING
 
 
@@ -12,9 +10,31 @@ class ModelConfig:
     # Model, currently a HuggingFace ID
     id: str
 
-    # LLM engine
+    # LLM engine API (vllm: the /generate endpoint, openai: the OpenAI compatible completions endpoint),
+    # a single address or a list of them to balance the load over multiple servers
     provider: str = 'vllm'
-    address: str = 'http://127.0.0.1:8000/generate'
+    address: Union[str, List[str]] = 'http://127.0.0.1:8000/generate'
+
+    # Maximum number of parallel generations per server (0: limited only by parallel)
+    endpoint_parallel: int = 0
+
+    # Seconds to wait for a generation (0: no limit), retries of failed generations after a backoff
+    timeout: float = 0.0
+    retries: int = 2
+
+    # Seconds to connect to a server and to wait for each read of a response (0: no limit)
+    connect_timeout: float = 10.0
+    read_timeout: float = 0.0
+
+    # Start a duplicate of generations running longer than the 95th percentile of the latency
+    hedge: bool = False
+
+    # Local tokenizer: path of a HuggingFace tokenizer.json (or its folder) or tiktoken:ENCODING,
+    # the tiktoken encoding of gpt-3.5 is used as an approximation if not configured
+    tokenizer: str = ''
+
+    # Prompt template with {system} and {instruction} placeholders, the known one of the model ID if empty
+    template: str = ''
 
     # Context window size
     context: int = 4096
@@ -35,9 +55,13 @@ class ModelConfig:
     stop: Union[None, str, List[str]] = None
     ignore_eos: bool = False
 
+    @property
+    def addresses(self) -> List[str]:
+        return [self.address] if isinstance(self.address, str) else list(self.address)
+
     @property
     def prompt_template(self) -> str:
-        return MAPPING[self.id]
+        return self.template or MAPPING[self.id]
 
     @property
     def sampling_params_dict(self) -> Dict[str, Any]:
@@ -82,12 +106,16 @@ class Config:
         )
 
     def save(self, path: str):
+        import toml
+
         os.makedirs(os.path.dirname(path), exist_ok=True)
         with open(path, 'wt', encoding='utf-8') as f:
             toml.dump(asdict(self), f)
 
     @classmethod
     def load(cls, path: str) -> "Config":
+        import toml
+
         with open(path, 'rt', encoding='utf-8') as f:
             data = toml.load(f)
         return cls.from_data(data)
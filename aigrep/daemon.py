@@ -0,0 +1,355 @@
+""" Daemon serving the jobs of the clients over a Unix socket
+
+Starting the command line tool for each job loads the tokenizers, opens new
+connections and the result cache every time. The daemon keeps all of them
+warm: the models are loaded once and shared by all jobs, as well as the cache.
+The parallel generations of each model are limited globally by the parallelism
+of the daemon, shared fairly between the jobs running (see scheduler.py).
+
+Each job is the command line of a client (see client.py), run as the command
+line tool would in the working directory of the client, the output is streamed
+back to be printed by the client. Options of the models and the cache are
+those of the daemon, the same options of the jobs are ignored.
+
+Jobs read and write files with the permissions of the daemon, so only the
+user running the daemon may submit them: the socket is accessible only by
+that user, and the user of the client is checked as well where supported.
+Stdin of the client is streamed to the job, read by the chunker as it arrives.
+
+"""
+import asyncio
+import io
+import json
+import os
+import signal
+import socket
+import struct
+import sys
+import time
+from argparse import ArgumentParser
+from typing import Dict, List, Optional, Union, Set
+
+from aigrep.arguments import ArgsNamespace, create_argument_parser
+from aigrep.cache import ResultCache
+from aigrep.chunker import Source
+from aigrep.cli import load_config, load_model, find_models
+from aigrep.config import Config, ModelConfig
+from aigrep.limiter import Limiter
+from aigrep.model import Model
+from aigrep.processor import Processor
+from aigrep.scheduler import FairScheduler, FairLimiter
+from aigrep.sink import PrintSink
+
+# Arguments naming files, relative to the working directory of the client
+FILE_ARGUMENTS = ('system_file', 'keywords_file', 'incremental', 'journal', 'prometheus')
+
+# Validation modes which can be checked before running the job
+VALIDATION_MODES = ('json', 'yaml', 'toml')
+
+# Maximum length of a request line (long lists of paths)
+REQUEST_LIMIT = 1 << 24
+
+# Permissions of the socket, accessible only by the user running the daemon
+SOCKET_MODE = 0o600
+
+
+class JobArgumentError(Exception):
+    """ Invalid command line of a job (or the help), the message is sent to the client """
+
+    def __init__(self, message: str, code: int = 2):
+        super().__init__(message)
+        self.code: int = code
+
+
+class JobArgumentParser(ArgumentParser):
+    """ Raises instead of printing to the stderr of the daemon and exiting """
+
+    def error(self, message: str):
+        raise JobArgumentError(f'{self.format_usage()}{self.prog}: error: {message}')
+
+    def print_help(self, file=None):
+        raise JobArgumentError(self.format_help().rstrip('\n'), 0)
+
+
+def encode_message(**kws) -> bytes:
+    return json.dumps(kws).encode('utf-8') + b'\n'
+
+
+def peer_uid(sock) -> Optional[int]:
+    """ User ID of the client connected, None if not supported by the platform """
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+
+    # struct ucred
+    pid, uid, gid = struct.unpack('3i', sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')))
+    return uid
+
+
+class SocketInput(io.RawIOBase):
+    """ Stdin of the client, read from the socket by the chunker running in a thread
+
+    Stopping it ends the input, so the chunker of a stopped job is not left waiting for the client.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, loop: asyncio.AbstractEventLoop):
+        super().__init__()
+        self.reader: asyncio.StreamReader = reader
+        self.loop: asyncio.AbstractEventLoop = loop
+
+        # Accessed in the event loop only
+        self.reading: Optional[asyncio.Future] = None
+        self.stopped: bool = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = asyncio.run_coroutine_threadsafe(self.read_socket(len(buffer)), self.loop).result()
+        size = len(data)
+        buffer[:size] = data
+        return size
+
+    async def read_socket(self, size: int) -> bytes:
+        if self.stopped:
+            return b''
+
+        self.reading = asyncio.ensure_future(self.reader.read(size))
+        try:
+            return await self.reading
+        except asyncio.CancelledError:
+            return b''
+        finally:
+            self.reading = None
+
+    def stop(self):
+        self.stopped = True
+        if self.reading is not None:
+            self.reading.cancel()
+
+
+class SocketSink(PrintSink):
+    """ Streams the lines printed to the client
+
+    Waits for the client to read the outputs, so a slow client holds up its job instead of
+    buffering all the outputs. The job is stopped if the client disconnects.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter, json_output: bool = False, log_format: str = '%s'):
+        super().__init__(json_output, log_format)
+        self.writer: asyncio.StreamWriter = writer
+        self.processor: Optional[Processor] = None
+
+    async def output(self, chunk):
+        await super().output(chunk)
+        if self.closed:
+            return
+
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            self.closed = True
+            if self.processor is not None:
+                self.processor.stop()
+
+    def write(self, text: str):
+        if not self.closed:
+            self.writer.write(encode_message(out=text))
+
+
+class JobProcessor(Processor):
+    """ Processor of a job, its parallel generations are limited by the fair share of the job as well """
+
+    def __init__(self, daemon: "Daemon", job: int, *args, **kws):
+        # Set before the stages are created
+        self.daemon: Daemon = daemon
+        self.job: int = job
+        super().__init__(*args, **kws)
+
+    def create_limiter(self, model: Model, parallel: int) -> Limiter:
+        return FairLimiter(super().create_limiter(model, parallel), self.daemon.scheduler(model), self.job)
+
+
+class Daemon:
+
+    def __init__(self, args: ArgsNamespace, config: Config):
+        self.args: ArgsNamespace = args
+        self.config: Config = config
+        self.path: str = os.path.expanduser(args.socket)
+        self.parser = create_argument_parser(JobArgumentParser)
+        self.sink = PrintSink(args.json, args.format)
+        self.verbose: bool = args.verbose > 0
+
+        # Warm models and the global limits of their parallel generations by model ID
+        self.models: Dict[str, Model] = {}
+        self.schedulers: Dict[str, FairScheduler] = {}
+
+        self.cache: Optional[ResultCache] = ResultCache(args.cache_dir, args.cache_size, args.cache_age) if args.cache else None
+
+        # Processors of the jobs running
+        self.processors: Set[Processor] = set()
+        self.handlers: Set[asyncio.Task] = set()
+        self.jobs: int = 0
+
+    def log_event(self, event: str, **kws):
+        self.sink.event(event, kws)
+
+    def log_verbose(self, event: str, **kws):
+        if self.verbose:
+            self.log_event(event, **kws)
+
+    def model(self, cfg: ModelConfig) -> Model:
+        model = self.models.get(cfg.id)
+        if model is None:
+            # Overridden by the options of the daemon
+            model = self.models[cfg.id] = load_model(self.args, cfg)
+        return model
+
+    def scheduler(self, model: Model) -> FairScheduler:
+        scheduler = self.schedulers.get(model.cfg.id)
+        if scheduler is None:
+            scheduler = self.schedulers[model.cfg.id] = FairScheduler(max(1, model.cfg.parallel))
+        return scheduler
+
+    def remove_stale_socket(self):
+        if not os.path.exists(self.path):
+            return
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(self.path)
+            except OSError:
+                os.unlink(self.path)
+                return
+
+        print(f'Daemon already running at {self.path}')
+        sys.exit(1)
+
+    async def serve(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.remove_stale_socket()
+
+        # Created without access by other users, even for the moment before changing its mode
+        umask = os.umask(0o777 & ~SOCKET_MODE)
+        try:
+            server = await asyncio.start_unix_server(self.handle, self.path, limit=REQUEST_LIMIT)
+        finally:
+            os.umask(umask)
+        os.chmod(self.path, SOCKET_MODE)
+
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stopped.set)
+
+        self.log_event('SERVING', socket=self.path, models=[cfg.id for cfg in self.config.models])
+        try:
+            async with server:
+                await stopped.wait()
+                server.close()
+
+                # Running jobs are stopped, their clients get the outputs so far
+                for processor in self.processors:
+                    processor.stop()
+                if self.handlers:
+                    await asyncio.wait(self.handlers)
+        finally:
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            for model in self.models.values():
+                await model.close()
+            if self.cache is not None:
+                self.cache.close()
+            self.log_event('STOPPED', jobs=self.jobs)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.jobs += 1
+        job = self.jobs
+        handler = asyncio.current_task()
+        self.handlers.add(handler)
+        started = time.perf_counter()
+        code = 1
+        try:
+            code = await self.run_job(job, reader, writer)
+        except JobArgumentError as e:
+            writer.write(encode_message(out=str(e)))
+            code = e.code
+        except SystemExit as e:
+            # Exits of the processor, like an invalid validation mode
+            code = e.code if isinstance(e.code, int) else 1
+        except (AssertionError, ValueError, OSError, RuntimeError) as e:
+            writer.write(encode_message(out=f'ERROR: {e}'))
+        except Exception as e:
+            # Malformed request or a bug, the client gets its exit code anyway
+            self.log_event('JOB_ERROR', job=job, error=f'{e.__class__.__name__}: {e}')
+            writer.write(encode_message(out=f'ERROR: {e.__class__.__name__}: {e}'))
+        finally:
+            self.handlers.discard(handler)
+            self.log_verbose('JOB_FINISHED', job=job, exit=code, duration=round(time.perf_counter() - started, 3), running=len(self.handlers))
+            try:
+                writer.write(encode_message(exit=code))
+                await writer.drain()
+                writer.close()
+            except ConnectionError:
+                pass
+
+    async def run_job(self, job: int, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> int:
+        # Read first, so the client gets the error instead of a broken connection
+        line = await reader.readline()
+
+        uid = peer_uid(writer.get_extra_info('socket'))
+        if uid is not None and uid != os.getuid():
+            self.log_event('REFUSED', job=job, uid=uid)
+            raise PermissionError(f'Jobs of other users are refused: uid {uid}')
+
+        request = json.loads(line)
+        cwd: str = request['cwd']
+        args: ArgsNamespace = ArgsNamespace.from_args(self.parser.parse_args(request['argv']))
+        self.log_verbose('JOB_STARTED', job=job, argv=request['argv'], cwd=cwd, running=len(self.handlers))
+
+        for name in FILE_ARGUMENTS:
+            path = getattr(args, name)
+            if path:
+                setattr(args, name, os.path.join(cwd, path))
+
+        if args.validate is not None and args.validate not in VALIDATION_MODES:
+            raise ValueError(f'Invalid validation mode: {args.validate}')
+
+        models = [self.model(cfg) for cfg in find_models(args, self.config)]
+
+        if args.test:
+            for model in models:
+                if not await model.test():
+                    writer.write(encode_message(out=f'FAILED: {model.cfg.id}' if len(models) > 1 else 'FAILED'))
+                    return 1
+            writer.write(encode_message(out='OK'))
+            return 0
+
+        # Stdin of the client follows the request
+        inputs: List[Union[str, Source]] = args.paths or ['-']
+        stdin: Optional[SocketInput] = None
+        if request['stdin']:
+            stdin = SocketInput(reader, asyncio.get_running_loop())
+            inputs = [Source('-', stdin) if path == '-' else path for path in inputs]
+
+        # The shared cache is passed to the processor instead
+        cache = self.cache if args.cache else None
+        args.cache = False
+
+        sink = SocketSink(writer, args.json, args.format)
+        processor = JobProcessor(self, job, args, self.config, models[0], models[1:], sink, cache, cwd)
+        sink.processor = processor
+
+        self.processors.add(processor)
+        try:
+            return 0 if await processor.process(inputs) else 1
+        finally:
+            self.processors.discard(processor)
+
+            # Stdin may still be read by the chunker of a stopped job
+            if stdin is not None:
+                stdin.stop()
+
+
+async def serve(args: ArgsNamespace):
+    path, config = load_config(args)
+    await Daemon(args, config).serve()
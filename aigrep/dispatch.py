@@ -0,0 +1,54 @@
+""" Order of dispatching the generations
+
+By default the chunks are dispatched in input order, so the chunks of a huge
+file at the end of the input start last and hold up the end of the run. The
+printer puts the outputs back into input order anyway, so the chunks waiting
+for a generator can be dispatched in any order without changing the output.
+
+The queue holds up to the lookahead number of generations waiting, the next
+one dispatched is chosen from those by its estimated cost (tokens of the
+input): the longest first to start the slow generations early and shorten
+the total time, or the shortest first to print the first outputs sooner.
+The lookahead bounds the memory used by the chunks read ahead.
+
+"""
+from asyncio import Queue
+from heapq import heappush, heappop
+from typing import Any, Callable, List, Tuple
+
+SCHEDULES = ('fifo', 'longest', 'shortest')
+
+# Default lookahead of the size-aware schedules in times the parallel generations
+LOOKAHEAD_FACTOR = 8
+
+
+class DispatchQueue(Queue):
+    """ Queue of the generations waiting, ties are dispatched in input order """
+
+    def __init__(self, maxsize: int = 0, schedule: str = 'fifo', cost: Callable[[Any], int] = lambda item: 0):
+        assert schedule in SCHEDULES, f'Invalid schedule: {schedule}'
+
+        # Set before the queue itself is created
+        self.schedule: str = schedule
+        self.cost: Callable[[Any], int] = cost
+        super().__init__(maxsize)
+
+    def priority(self, item: Any) -> int:
+        if self.schedule == 'longest':
+            return -self.cost(item)
+        if self.schedule == 'shortest':
+            return self.cost(item)
+        return 0
+
+    # Overriding the storage of asyncio.Queue, the same way as asyncio.PriorityQueue does
+
+    def _init(self, maxsize: int):
+        self._queue: List[Tuple[int, int, Any]] = []
+        self._sequence: int = 0
+
+    def _put(self, item: Any):
+        self._sequence += 1
+        heappush(self._queue, (self.priority(item), self._sequence, item))
+
+    def _get(self) -> Any:
+        return heappop(self._queue)[2]
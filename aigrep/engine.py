@@ -0,0 +1,184 @@
+""" Library API
+
+The engine holds the models (with their servers and connections) and the
+result cache, so a long-lived process can run many jobs concurrently over
+them. Each job has its own options, budget and concurrency limit, its
+results are streamed as they are ready instead of being printed.
+
+    async with Engine(config) as engine:
+        async for result in engine.run(['src/'], system='List the functions as JSON', validate='json'):
+            print(result.path, result.lineno, result.output)
+
+"""
+import asyncio
+from dataclasses import dataclass
+from typing import List, Optional, Iterable, Union, AsyncIterator, Dict, Any
+
+from aigrep.arguments import ArgsNamespace, create_argument_parser
+from aigrep.cache import ResultCache, DEFAULT_CACHE_DIR, DEFAULT_CACHE_MAX_SIZE, DEFAULT_CACHE_MAX_AGE
+from aigrep.chunker import Source
+from aigrep.config import Config, DEFAULT_CONFIG
+from aigrep.model import Model
+from aigrep.processor import Processor, Chunk
+from aigrep.sink import QueueSink
+
+# Options of the command line tool which are set on the engine, not per job
+ENGINE_OPTIONS = {
+    'config', 'info', 'write', 'json', 'format', 'model', 'cascade', 'test',
+    'timeout', 'connect_timeout', 'read_timeout', 'retries', 'hedge', 'window', 'cache_dir', 'cache_size', 'cache_age', 'paths',
+}
+
+
+@dataclass
+class Result:
+    index: int
+    path: str
+    lineno: int
+    lines: int
+    output: str
+    successful: bool
+
+    # Model of the cascade answering
+    model: str = ''
+
+    @classmethod
+    def from_chunk(cls, chunk: Chunk) -> "Result":
+        return cls(chunk.index, chunk.path, chunk.lineno, chunk.lines, chunk.output, chunk.successful, chunk.model)
+
+
+@dataclass
+class Event:
+    event: str
+    data: Dict[str, Any]
+
+
+class Job:
+    """ Processing of the inputs, iterate over it for the results in input order
+
+    Started on the first iteration or wait. Leaving the iteration early or cancelling stops the processing.
+    """
+
+    def __init__(self, processor: Processor, sink: QueueSink, inputs: Iterable[Union[str, Source]]):
+        self.processor: Processor = processor
+        self.sink: QueueSink = sink
+        self.inputs: Iterable[Union[str, Source]] = inputs
+        self.task: Optional[asyncio.Task] = None
+
+        # Set once finished: all chunks successful within the budget, the answer of a reduce job
+        self.ok: Optional[bool] = None
+        self.answer: Optional[str] = None
+
+    def start(self):
+        if self.task is not None:
+            return
+
+        self.task = asyncio.create_task(self.processor.process(self.inputs))
+        # Also ends the iteration if the processing failed
+        self.task.add_done_callback(lambda _: self.sink.close())
+
+    def cancel(self):
+        self.processor.stop()
+
+    async def __aiter__(self) -> AsyncIterator[Union[Result, Event]]:
+        self.start()
+        try:
+            while 1:
+                item = await self.sink.get()
+                if item is None:
+                    break
+
+                if isinstance(item, tuple):
+                    event, data = item
+                    if event == 'ANSWER':
+                        self.answer = data['output']
+                        if not self.sink.events:
+                            continue
+                    yield Event(event, data)
+                else:
+                    yield Result.from_chunk(item)
+
+            self.ok = await self.task
+        finally:
+            if not self.task.done():
+                self.cancel()
+                await asyncio.wait([self.task])
+
+    async def wait(self) -> bool:
+        async for _ in self:
+            pass
+        return self.ok
+
+
+class Engine:
+
+    def __init__(self,
+                 config: Optional[Config] = None,
+                 models: Optional[List[str]] = None,
+                 cache: bool = False,
+                 cache_dir: str = DEFAULT_CACHE_DIR,
+                 cache_size: int = DEFAULT_CACHE_MAX_SIZE,
+                 cache_age: float = DEFAULT_CACHE_MAX_AGE,
+                 buffer: int = 256):
+        """ Models: IDs of the configured models, more than one for a cascade (defaults to the first one)
+
+        Cache: keep the results in the result cache, off by default as on the command line.
+
+        Buffer: maximum number of results waiting for the consumer of each job.
+        """
+        self.config: Config = config or DEFAULT_CONFIG
+        assert self.config.models, 'No models configured'
+
+        configured = {cfg.id: cfg for cfg in self.config.models}
+        ids = models or [self.config.models[0].id]
+        for model_id in ids:
+            if model_id not in configured:
+                raise ValueError(f'No model configured with ID: {model_id}')
+
+        self.models: List[Model] = [Model(configured[model_id].clone()) for model_id in ids]
+        self.cache: Optional[ResultCache] = ResultCache(cache_dir, cache_size, cache_age) if cache else None
+        self.buffer: int = buffer
+        self.parser = create_argument_parser()
+
+    async def __aenter__(self) -> "Engine":
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        for model in self.models:
+            await model.close()
+
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+
+    def job_args(self, options: Dict[str, Any]) -> ArgsNamespace:
+        """ Options are named as the destinations of the command line arguments, defaults are the same """
+        args: ArgsNamespace = ArgsNamespace.from_args(self.parser.parse_args([]))
+        for name, value in options.items():
+            if name in ENGINE_OPTIONS or not hasattr(args, name):
+                raise TypeError(f'Invalid job option: {name}')
+            setattr(args, name, value)
+
+        # Passed to the processor instead
+        args.cache = False
+        return args
+
+    def run(self, inputs: Iterable[Union[str, Source]], events: bool = False, **options) -> Job:
+        """ Inputs: file or folder paths, glob patterns or sources; options: same as the command line arguments
+
+        Iterate over the job for the results, with events the log events (as verbose as the option) are included.
+        """
+        use_cache = options.pop('cache', True)
+        args = self.job_args(options)
+
+        sink = QueueSink(self.buffer, events)
+        processor = Processor(args, self.config, self.models[0], self.models[1:], sink, self.cache if use_cache else None)
+        return Job(processor, sink, inputs)
+
+    async def answer(self, inputs: Iterable[Union[str, Source]], **options) -> Optional[str]:
+        """ Single answer for all the inputs by map-reduce """
+        job = self.run(inputs, reduce=True, **options)
+        await job.wait()
+        return job.answer
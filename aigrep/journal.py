@@ -0,0 +1,99 @@
+""" Checkpoint journal of the chunks completed
+
+Each chunk is appended to the journal as soon as its output is available,
+so an interrupted run (crash, kill, budget exceeded) can be resumed without
+repeating the generations already done. Chunks are identified by their
+index, path, line number and the hash of their text, so only the chunks
+read exactly the same way are resumed.
+
+The journal is a JSON lines file, the first line is a header with the
+hash of the settings. A partial last line left by a crash is dropped.
+
+"""
+import json
+import os
+from dataclasses import dataclass, asdict
+from typing import Dict, Optional, TextIO
+
+VERSION = 1
+
+
+@dataclass
+class JournalEntry:
+    index: int
+    path: str
+    lineno: int
+    lines: int
+    digest: str
+    output: str
+    cost: int
+
+    @classmethod
+    def from_data(cls, data: dict) -> "JournalEntry":
+        return cls(**data)
+
+
+class Journal:
+
+    def __init__(self, path: str, key: str, resume: bool):
+        self.path: str = path
+        self.key: str = key
+
+        self.entries: Dict[int, JournalEntry] = {}
+        if resume:
+            self.load()
+
+        if self.entries:
+            self.file: TextIO = open(path, 'at', encoding='utf-8')
+        else:
+            self.file = open(path, 'wt', encoding='utf-8')
+            self.write(dict(version=VERSION, key=key))
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+
+        # Offset of the end of the last complete and valid line
+        offset = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    break
+
+                if not offset:
+                    if data.get('version') != VERSION or data.get('key') != self.key:
+                        return
+                else:
+                    entry = JournalEntry.from_data(data)
+                    self.entries[entry.index] = entry
+
+                offset += len(line)
+
+        if not offset:
+            return
+
+        # Drop the partial or corrupted line, so new entries are appended cleanly
+        with open(self.path, 'r+b') as f:
+            f.truncate(offset)
+
+    def find(self, index: int, path: str, lineno: int, digest: str) -> Optional[JournalEntry]:
+        entry = self.entries.get(index)
+        if entry is None or entry.path != path or entry.lineno != lineno or entry.digest != digest:
+            return None
+        return entry
+
+    def record(self, entry: JournalEntry):
+        self.write(asdict(entry))
+
+    def write(self, data: dict):
+        # Flushed line by line, so a killed process loses at most the line being written
+        self.file.write(json.dumps(data) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
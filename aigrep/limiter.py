@@ -0,0 +1,133 @@
+""" Limiting the number of parallel generations
+
+The adaptive limiter tunes the limit based on the latency and errors observed (AIMD).
+The limit is raised while the latency per token stays close to the lowest seen,
+raised faster until the first sign of congestion (slow start). The limit is
+cut back if the latency grows beyond tolerance or generations fail.
+
+"""
+import asyncio
+import time
+from typing import Optional, Callable
+
+# Weight of the latest sample in the moving average of the latency per token
+SMOOTHING = 0.2
+
+# Relative upwards drift of the baseline latency per sample, so it can recover from outliers
+BASELINE_DRIFT = 0.001
+
+
+class Limiter:
+    """ Fixed limit
+    """
+
+    def __init__(self, limit: int):
+        assert limit > 0, f'Invalid limit: {limit}'
+        self.limit: float = limit
+        self.active: int = 0
+        self.condition = asyncio.Condition()
+
+    def slot(self) -> 'Slot':
+        return Slot(self)
+
+    async def acquire(self):
+        async with self.condition:
+            while self.active >= int(self.limit):
+                await self.condition.wait()
+            self.active += 1
+
+    async def release(self, latency: float, tokens: int, error: bool):
+        async with self.condition:
+            self.active -= 1
+            self.update(latency, tokens, error)
+            self.condition.notify_all()
+
+    def update(self, latency: float, tokens: int, error: bool):
+        pass
+
+
+class AdaptiveLimiter(Limiter):
+
+    def __init__(self,
+                 minimum: int,
+                 maximum: int,
+                 tolerance: float = 2.0,
+                 backoff: float = 0.75,
+                 on_change: Optional[Callable[[int], None]] = None):
+        assert 0 < minimum <= maximum, f'Invalid limits: {minimum}..{maximum}'
+        assert tolerance > 1.0, f'Invalid tolerance: {tolerance}'
+        assert 0.0 < backoff < 1.0, f'Invalid backoff: {backoff}'
+
+        super().__init__(minimum)
+        self.minimum: int = minimum
+        self.maximum: int = maximum
+        self.tolerance: float = tolerance
+        self.backoff: float = backoff
+        self.on_change: Optional[Callable[[int], None]] = on_change
+
+        # Slow start threshold
+        self.threshold: float = maximum
+
+        # Latency per token: moving average and the baseline (lowest seen)
+        self.latency: Optional[float] = None
+        self.baseline: Optional[float] = None
+
+        self.last_decrease: float = 0.0
+
+    def update(self, latency: float, tokens: int, error: bool):
+        previous = int(self.limit)
+
+        if error:
+            self.decrease(latency)
+        elif tokens > 0:
+            sample = latency / tokens
+            self.latency = sample if self.latency is None else self.latency * (1.0 - SMOOTHING) + sample * SMOOTHING
+            self.baseline = self.latency if self.baseline is None else min(self.latency, self.baseline * (1.0 + BASELINE_DRIFT))
+
+            if self.latency > self.tolerance * self.baseline:
+                self.decrease(latency)
+            elif self.active + 1 >= previous:
+                # Raise the limit only if it was fully used
+                self.increase()
+
+        if self.on_change is not None and int(self.limit) != previous:
+            self.on_change(int(self.limit))
+
+    def increase(self):
+        if self.limit < self.threshold:
+            self.limit += 1.0
+        else:
+            self.limit += 1.0 / self.limit
+        self.limit = min(self.limit, float(self.maximum))
+
+    def decrease(self, latency: float):
+        # At most once per round trip, the other generations in flight were started before the decrease
+        now = time.monotonic()
+        if now - self.last_decrease < latency:
+            return
+
+        self.last_decrease = now
+        self.limit = max(float(self.minimum), self.limit * self.backoff)
+        self.threshold = self.limit
+
+
+class Slot:
+    """ Holds a place in the limiter while a generation is running
+
+    Set the tokens used before leaving the context.
+    """
+
+    def __init__(self, limiter: Limiter):
+        self.limiter: Limiter = limiter
+        self.tokens: int = 0
+        self.started: float = 0.0
+
+    async def __aenter__(self) -> 'Slot':
+        await self.limiter.acquire()
+        self.started = time.monotonic()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        latency = time.monotonic() - self.started
+        error = exc_type is not None and not issubclass(exc_type, asyncio.CancelledError)
+        await self.limiter.release(latency, self.tokens, error)
@@ -0,0 +1,114 @@
+""" Manifest of a previous run for incremental processing
+
+Records the size, modification time and content hash of each file
+processed, together with the boundaries and outputs of its chunks.
+
+Unchanged files are replayed from the manifest on the next run,
+only the files changed are read, chunked and sent to the LLM again.
+
+The manifest is valid only for the same settings, which is
+ensured by storing a hash of them as the key of the manifest.
+
+"""
+import json
+import os
+from dataclasses import dataclass, field, asdict
+from typing import List, Dict, Optional
+
+from aigrep.utils import file_digest
+
+VERSION = 1
+
+
+@dataclass
+class ChunkEntry:
+    lineno: int
+    lines: int
+    output: str
+
+    @classmethod
+    def from_data(cls, data: dict) -> "ChunkEntry":
+        return cls(**data)
+
+
+@dataclass
+class FileEntry:
+    path: str
+    size: int
+    mtime: float
+    digest: str
+    chunks: List[ChunkEntry] = field(default_factory=list)
+
+    @classmethod
+    def from_data(cls, data: dict) -> "FileEntry":
+        return cls(
+            path=data['path'],
+            size=data['size'],
+            mtime=data['mtime'],
+            digest=data['digest'],
+            chunks=[ChunkEntry.from_data(item) for item in data['chunks']],
+        )
+
+
+@dataclass
+class Manifest:
+    key: str
+    files: Dict[str, FileEntry] = field(default_factory=dict)
+
+    def unchanged(self, path: str, local_path: str = '') -> Optional[FileEntry]:
+        entry = self.files.get(path)
+        if entry is None:
+            return None
+
+        try:
+            st = os.stat(local_path or path)
+        except OSError:
+            return None
+
+        if st.st_size != entry.size:
+            return None
+
+        if st.st_mtime == entry.mtime:
+            return entry
+
+        # Touched, but maybe not modified
+        if file_digest(local_path or path) != entry.digest:
+            return None
+
+        entry.mtime = st.st_mtime
+        return entry
+
+    @classmethod
+    def from_data(cls, data: dict) -> "Manifest":
+        return cls(
+            key=data['key'],
+            files={
+                item['path']: FileEntry.from_data(item)
+                for item in data['files']
+            }
+        )
+
+    def save(self, path: str):
+        data = dict(
+            version=VERSION,
+            key=self.key,
+            files=[asdict(entry) for entry in self.files.values()],
+        )
+
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, key: str) -> "Manifest":
+        if not os.path.exists(path):
+            return cls(key)
+
+        with open(path, 'rt', encoding='utf-8') as f:
+            data = json.load(f)
+
+        if data.get('version') != VERSION or data.get('key') != key:
+            return cls(key)
+
+        return cls.from_data(data)
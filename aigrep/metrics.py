@@ -0,0 +1,198 @@
+""" Pipeline metrics
+
+Counters, histograms of the time spent in each stage and gauges sampled over time.
+Summarized as JSON at the end of the run or written periodically as a Prometheus textfile.
+
+"""
+import math
+import os
+import time
+from typing import Dict, List, Any, Optional, AsyncIterable, AsyncIterator, TypeVar
+
+# Upper bounds of the histogram buckets in seconds, the last bucket is unbounded
+BUCKETS: List[float] = [0.0001 * 2 ** i for i in range(22)]
+
+PREFIX = 'aigrep_'
+
+T = TypeVar('T')
+
+
+class Histogram:
+
+    def __init__(self):
+        self.counts: List[int] = [0] * (len(BUCKETS) + 1)
+        self.count: int = 0
+        self.sum: float = 0.0
+        self.min: float = math.inf
+        self.max: float = 0.0
+
+    def observe(self, value: float):
+        i = 0
+        while i < len(BUCKETS) and value > BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """ Upper bound of the bucket containing the quantile """
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        total = 0
+        for i, count in enumerate(self.counts):
+            total += count
+            if total >= rank:
+                return min(self.max, BUCKETS[i]) if i < len(BUCKETS) else self.max
+
+        return self.max
+
+    def summary(self) -> Dict[str, Any]:
+        if not self.count:
+            return dict(count=0)
+
+        return dict(
+            count=self.count,
+            sum=round(self.sum, 6),
+            min=round(self.min, 6),
+            mean=round(self.sum / self.count, 6),
+            p50=round(self.quantile(0.5), 6),
+            p95=round(self.quantile(0.95), 6),
+            p99=round(self.quantile(0.99), 6),
+            max=round(self.max, 6),
+        )
+
+
+class Gauge:
+
+    def __init__(self):
+        self.last: float = 0.0
+        self.count: int = 0
+        self.sum: float = 0.0
+        self.min: float = math.inf
+        self.max: float = -math.inf
+
+    def sample(self, value: float):
+        self.last = value
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def summary(self) -> Dict[str, Any]:
+        if not self.count:
+            return dict(samples=0)
+
+        return dict(
+            samples=self.count,
+            last=self.last,
+            min=self.min,
+            mean=round(self.sum / self.count, 3),
+            max=self.max,
+        )
+
+
+class Metrics:
+
+    def __init__(self):
+        self.started: float = time.monotonic()
+        self.counters: Dict[str, float] = {}
+        self.histograms: Dict[str, Histogram] = {}
+        self.gauges: Dict[str, Gauge] = {}
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def count(self, name: str, value: float = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+    def sample(self, name: str, value: float):
+        gauge = self.gauges.get(name)
+        if gauge is None:
+            gauge = self.gauges[name] = Gauge()
+        gauge.sample(value)
+
+    def timer(self, name: str) -> 'Timer':
+        return Timer(self, name)
+
+    async def timed_iter(self, name: str, iterable: AsyncIterable[T]) -> AsyncIterator[T]:
+        """ Observes the time taken to produce each item """
+        it = iterable.__aiter__()
+        while 1:
+            started = time.perf_counter()
+            try:
+                item = await it.__anext__()
+            except StopAsyncIteration:
+                return
+            self.observe(name, time.perf_counter() - started)
+            yield item
+
+    def summary(self) -> Dict[str, Any]:
+        elapsed = self.elapsed
+        return dict(
+            elapsed=round(elapsed, 3),
+            tokens_in_per_second=round(self.counters.get('tokens_in', 0) / elapsed, 1) if elapsed else 0.0,
+            tokens_out_per_second=round(self.counters.get('tokens_out', 0) / elapsed, 1) if elapsed else 0.0,
+            counters=dict(sorted(self.counters.items())),
+            seconds={name: h.summary() for name, h in sorted(self.histograms.items())},
+            gauges={name: g.summary() for name, g in sorted(self.gauges.items())},
+        )
+
+    def prometheus(self) -> str:
+        lines: List[str] = [
+            f'# TYPE {PREFIX}elapsed_seconds gauge',
+            f'{PREFIX}elapsed_seconds {self.elapsed:.3f}',
+        ]
+
+        for name, value in sorted(self.counters.items()):
+            lines.append(f'# TYPE {PREFIX}{name}_total counter')
+            lines.append(f'{PREFIX}{name}_total {value:g}')
+
+        for name, histogram in sorted(self.histograms.items()):
+            metric = f'{PREFIX}{name}_seconds'
+            lines.append(f'# TYPE {metric} histogram')
+            total = 0
+            for bound, count in zip(BUCKETS + [math.inf], histogram.counts):
+                total += count
+                le = '+Inf' if bound == math.inf else f'{bound:g}'
+                lines.append(f'{metric}_bucket{{le="{le}"}} {total}')
+            lines.append(f'{metric}_sum {histogram.sum:.6f}')
+            lines.append(f'{metric}_count {histogram.count}')
+
+        for name, gauge in sorted(self.gauges.items()):
+            lines.append(f'# TYPE {PREFIX}{name} gauge')
+            lines.append(f'{PREFIX}{name} {gauge.last:g}')
+
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str):
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wt', encoding='utf-8') as f:
+            f.write(self.prometheus())
+        os.replace(tmp_path, path)
+
+
+class Timer:
+    """ Observes the time spent in the context in the histogram given """
+
+    def __init__(self, metrics: Metrics, name: str):
+        self.metrics: Metrics = metrics
+        self.name: str = name
+        self.started: Optional[float] = None
+
+    def __enter__(self) -> 'Timer':
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.metrics.observe(self.name, time.perf_counter() - self.started)
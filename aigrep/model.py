@@ -1,10 +1,27 @@
-from typing import List, Tuple
+from dataclasses import dataclass
+from typing import List, Optional
 
-from vllm_client.async_client import AsyncVllmClient
 from vllm_client.sampling_params import SamplingParams
 
+from aigrep.balancer import Balancer
 from aigrep.config import ModelConfig
-from aigrep.utils import count_tokens
+from aigrep.providers import PROVIDERS, Completion, api_headers
+from aigrep.tokenizer import Tokenizer, load_tokenizer
+from aigrep.transport import Transport
+
+
+@dataclass
+class Generation:
+    # Generated texts without the prompt
+    outputs: List[str]
+
+    # Token usage, reported by the server or counted locally (the prompt is processed once for all outputs)
+    prompt_tokens: int
+    output_tokens: int
+
+    @property
+    def cost(self) -> int:
+        return self.prompt_tokens + self.output_tokens
 
 
 class Model:
@@ -18,38 +35,55 @@ class Model:
         assert cfg.context > 0, f'Invalid context size: {cfg.context}'
         assert cfg.parallel > 0, f'Invalid parallelism: {cfg.parallel}'
 
-        if cfg.provider == 'vllm':
-            self.client = AsyncVllmClient(cfg.address)
-        else:
+        provider = PROVIDERS.get(cfg.provider)
+        if provider is None:
             raise ValueError(f'Unknown model provider: {cfg.provider}')
 
-    async def generate(self, system: str, instruction: str, params: SamplingParams) -> List[Tuple[str, int]]:
+        self.tokenizer: Tokenizer = load_tokenizer(cfg.tokenizer)
+
+        # Connections for all parallel generations, hedging may run a duplicate of each
+        self.transport = Transport(cfg.parallel * (2 if cfg.hedge else 1), cfg.connect_timeout, cfg.read_timeout, api_headers(cfg.provider))
+        providers = [provider(cfg.id, address, self.transport) for address in cfg.addresses]
+        self.balancer = Balancer(providers, cfg.endpoint_parallel, cfg.timeout, cfg.retries, cfg.hedge)
+
+    async def generate(self, system: str, instruction: str, params: SamplingParams, prompt_tokens: Optional[int] = None) -> Generation:
+        """ Prompt tokens: known size of the prompt, counted only if not given """
         prompt = self.cfg.prompt_template.format(system=system, instruction=instruction)
+        if prompt_tokens is None:
+            prompt_tokens = self.tokenizer.count(prompt)
+
+        tokens = prompt_tokens + params.max_tokens * (params.best_of or params.n)
+        completion: Completion = await self.balancer.generate(prompt, params, tokens)
 
-        def fn(output) -> Tuple[str, int]:
-            generated = output[len(prompt):]
-            return generated, count_tokens(output)
+        # Counted locally if not reported by the server
+        outputs = completion.outputs
+        return Generation(
+            outputs=outputs,
+            prompt_tokens=prompt_tokens if completion.prompt_tokens is None else completion.prompt_tokens,
+            output_tokens=sum(self.tokenizer.count(output) for output in outputs) if completion.output_tokens is None else completion.output_tokens,
+        )
 
-        return [fn(output) for output in await self.client.generate(prompt, params)]
+    async def close(self):
+        await self.transport.close()
 
     async def test(self) -> bool:
-        outputs: List[Tuple[str, int]] = await self.generate(
+        generation: Generation = await self.generate(
             'You are a helpful assistant.',
             'You are a math student. What is the area of a unit square?',
             SamplingParams(**self.cfg.sampling_params_dict))
 
-        if len(outputs) != 1:
+        if len(generation.outputs) != 1:
             print('Wrong number of outputs')
             return False
 
-        output, cost = outputs[0]
+        output = generation.outputs[0]
 
         if '1' not in output and 'one' not in output.lower():
-            print(f'Unexpected output: {outputs!r}')
+            print(f'Unexpected output: {generation.outputs!r}')
             return False
 
-        if cost < count_tokens(output):
-            print(f'Unexpected cost: {outputs!r}')
+        if generation.prompt_tokens <= 0 or generation.output_tokens <= 0:
+            print(f'Unexpected token usage: {generation!r}')
             return False
 
         return True
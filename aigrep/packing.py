@@ -0,0 +1,60 @@
+""" Packing many small chunks into a single generation
+
+Saves repeating the system prompt for each small file and uses the context window better.
+The documents are delimited in the input and the model is asked to answer each of them
+after a delimiter line, so the output can be split back into per-chunk results.
+
+"""
+import re
+from typing import List, Optional
+
+PACK_SYSTEM = '''\
+{system}
+
+The input consists of {count} separate documents, each of them starts with a line like "### DOCUMENT 1".
+Follow the above instructions for each document separately.
+Write the answer for each document after a line like "### ANSWER 1", in the same order as the documents.
+Do NOT write anything else.'''
+
+DOCUMENT_DELIMITER = '### DOCUMENT {number}\n'
+
+RX_ANSWER_DELIMITER = re.compile(r'^[ \t]*#+[ \t]*ANSWER[ \t]+(\d+)[ \t]*:?[ \t]*$', re.MULTILINE | re.IGNORECASE)
+
+# Tokens reserved for the delimiter of each document
+PACK_ITEM_TOKENS = 8
+
+
+def format_pack_system(system: str, count: int) -> str:
+    return PACK_SYSTEM.format(system=system, count=count)
+
+
+def format_pack_input(texts: List[str]) -> str:
+    return ''.join(
+        DOCUMENT_DELIMITER.format(number=1 + i) + text + ('' if text.endswith('\n') else '\n')
+        for i, text in enumerate(texts)
+    )
+
+
+def split_pack_output(text: str, count: int) -> Optional[List[Optional[str]]]:
+    """ Splits the output into answers by document
+
+    Returns None if no answer delimiters were found at all,
+    the answers missing or repeated are None in the list.
+    """
+    matches = list(RX_ANSWER_DELIMITER.finditer(text))
+    if not matches:
+        return None
+
+    answers: List[Optional[str]] = [None] * count
+    seen = set()
+    for i, m in enumerate(matches):
+        number = int(m.group(1))
+        if not 1 <= number <= count:
+            continue
+
+        # A repeated answer is ambiguous
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+        answers[number - 1] = None if number in seen else text[m.end():end].strip()
+        seen.add(number)
+
+    return answers
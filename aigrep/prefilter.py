@@ -0,0 +1,138 @@
+""" Cheap local filtering of the chunks before sending them to the LLM
+
+Chunks not matching the include regexps or keywords, matching any of the
+exclude regexps or having overly long lines are skipped. Files looking
+binary or minified are skipped as a whole based on their beginning.
+
+Binary files contain NUL bytes, unless the encoding is not ASCII compatible
+(UTF-16 and UTF-32 encode most characters with NUL bytes), then they are
+the files failing to decode.
+
+Many keywords are matched in a single pass by an Aho-Corasick automaton
+if the optional pyahocorasick package is installed, otherwise by a regexp.
+
+These run in the worker pool together with chunking, so the filter must be picklable.
+
+"""
+import codecs
+import re
+from typing import List, Optional
+
+# Number of bytes at the beginning of the files to check for binary or minified content
+HEAD_SIZE = 1 << 16
+
+# Average line length above which a file is considered minified
+MINIFIED_LINE_LENGTH = 500
+
+
+def is_ascii_compatible(encoding: str) -> bool:
+    """ ASCII characters are encoded as single bytes of the same value """
+    try:
+        return 'A\0\n'.encode(encoding).endswith(b'A\0\n')
+    except LookupError:
+        # Unknown encoding, reported when reading the files
+        return True
+
+
+class KeywordMatcher:
+
+    def __init__(self, keywords: List[str], ignore_case: bool):
+        assert keywords, 'No keywords'
+        self.ignore_case: bool = ignore_case
+
+        try:
+            import ahocorasick
+        except ImportError:
+            ahocorasick = None
+
+        self.automaton = None
+        self.rx: Optional[re.Pattern] = None
+
+        if ahocorasick is None:
+            # Longest first, so the alternation does not stop at a shorter prefix
+            pattern = '|'.join(re.escape(keyword) for keyword in sorted(set(keywords), key=len, reverse=True))
+            self.rx = re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+        else:
+            self.automaton = ahocorasick.Automaton()
+            for keyword in keywords:
+                keyword = keyword.lower() if ignore_case else keyword
+                self.automaton.add_word(keyword, keyword)
+            self.automaton.make_automaton()
+
+    def search(self, text: str) -> bool:
+        if self.rx is not None:
+            return self.rx.search(text) is not None
+
+        if self.ignore_case:
+            text = text.lower()
+
+        for _ in self.automaton.iter(text):
+            return True
+
+        return False
+
+
+class Prefilter:
+
+    def __init__(self,
+                 include: Optional[List[str]] = None,
+                 exclude: Optional[List[str]] = None,
+                 keywords: Optional[List[str]] = None,
+                 ignore_case: bool = False,
+                 max_line_length: int = 0,
+                 skip_binary: bool = True,
+                 skip_minified: bool = False,
+                 encoding: str = 'utf-8'):
+        assert max_line_length >= 0, f'Invalid maximum line length: {max_line_length}'
+
+        flags = re.IGNORECASE if ignore_case else 0
+        self.include: List[re.Pattern] = [re.compile(pattern, flags) for pattern in include or ()]
+        self.exclude: List[re.Pattern] = [re.compile(pattern, flags) for pattern in exclude or ()]
+        self.keywords: Optional[KeywordMatcher] = KeywordMatcher(keywords, ignore_case) if keywords else None
+        self.skip_binary: bool = skip_binary
+        self.skip_minified: bool = skip_minified
+        self.encoding: str = encoding
+        self.ascii_compatible: bool = is_ascii_compatible(encoding)
+
+        # Matches a line longer than the maximum
+        self.rx_long_line: Optional[re.Pattern] = re.compile(f'[^\\n]{{{max_line_length + 1}}}') if max_line_length else None
+
+    def check_head(self, head: bytes) -> str:
+        """ Returns the event to skip the whole file with, empty if the file should be processed """
+        size, lines = len(head), head.count(b'\n')
+        if self.ascii_compatible:
+            binary = b'\0' in head
+        else:
+            # The last character may be cut off at the end of the head
+            try:
+                text = codecs.getincrementaldecoder(self.encoding)().decode(head)
+            except UnicodeDecodeError:
+                binary = True
+            else:
+                binary = '\0' in text
+                size, lines = len(text), text.count('\n')
+
+        if self.skip_binary and binary:
+            return 'SKIP_BINARY'
+
+        if self.skip_minified and size > MINIFIED_LINE_LENGTH and size / (1 + lines) > MINIFIED_LINE_LENGTH:
+            return 'SKIP_MINIFIED'
+
+        return ''
+
+    def check(self, text: str) -> str:
+        """ Returns the reason to skip the chunk, empty if it should be processed """
+        if self.rx_long_line is not None and self.rx_long_line.search(text) is not None:
+            return 'LONG_LINE'
+
+        for rx in self.exclude:
+            if rx.search(text) is not None:
+                return 'EXCLUDED'
+
+        if self.include and not any(rx.search(text) is not None for rx in self.include):
+            return 'NOT_INCLUDED'
+
+        if self.keywords is not None and not self.keywords.search(text):
+            return 'NO_KEYWORD'
+
+        return ''
@@ -4,18 +4,35 @@ import json
 import os.path
 import re
 import sys
-from asyncio import Queue, Task, Semaphore
-from dataclasses import dataclass, asdict
-from typing import List, TextIO, AsyncIterable, Tuple, Optional, Iterable, Set
+import time
+from asyncio import Queue, Task, Future
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from typing import List, Tuple, Optional, Iterable, AsyncIterator, Set, Dict, Deque, Union
 
-import toml
-import yaml
 from vllm_client.sampling_params import SamplingParams
 
+from aigrep.budget import Budget, BudgetExceeded
+from aigrep.cache import ResultCache, cache_key
+from aigrep.chunker import FileChunks, Source, chunk_file, chunk_stream, chunk_source
 from aigrep.config import Config
-from aigrep.model import Model
-from aigrep.utils import count_tokens, extract_code_block
-from arguments import ArgsNamespace
+from aigrep.dispatch import DispatchQueue, LOOKAHEAD_FACTOR
+from aigrep.journal import Journal, JournalEntry
+from aigrep.limiter import Limiter, AdaptiveLimiter
+from aigrep.manifest import Manifest, FileEntry, ChunkEntry
+from aigrep.metrics import Metrics
+from aigrep.model import Model, Generation
+from aigrep.prefilter import Prefilter
+from aigrep.packing import PACK_ITEM_TOKENS, format_pack_system, format_pack_input, split_pack_output
+from aigrep.reduce import Reducer, ReduceBatch, format_reduce_system, format_reduce_input
+from aigrep.reorder import ReorderBuffer
+from aigrep.sink import Sink, PrintSink
+from aigrep.utils import extract_code_block, text_digest
+from aigrep.arguments import ArgsNamespace
+
+# Directory entries examined between yielding to the event loop
+DISCOVERY_BATCH = 1024
 
 
 @dataclass
@@ -28,63 +45,253 @@ class Chunk:
     output: str = ''
     attempt: int = 0
     successful: bool = False
+    tokens: int = 0
+    digest: str = ''
+    model: str = ''
+
+
+@dataclass
+class Pack:
+    chunks: List[Chunk]
+
+    @property
+    def tokens(self) -> int:
+        return sum(chunk.tokens for chunk in self.chunks)
+
+
+@dataclass
+class Stage:
+    # Model of the cascade with its own sampling parameters and concurrency
+    model: Model
+    prompt_tokens: int
+    params: SamplingParams
+    sample_params: SamplingParams
+    parallel: int
+    limiter: Limiter
+
+    # Chunks answered by this model and escalated from it to the next one
+    answered: int = 0
+    escalated: int = 0
 
 
 class Processor:
 
-    def __init__(self, args: ArgsNamespace, config: Config, model: Model):
+    def __init__(self,
+                 args: ArgsNamespace,
+                 config: Config,
+                 model: Model,
+                 escalation: Optional[List[Model]] = None,
+                 sink: Optional[Sink] = None,
+                 cache: Optional[ResultCache] = None,
+                 cwd: str = ''):
         super().__init__()
         self.args: ArgsNamespace = args
         self.config: Config = config
         self.model: Model = model
 
-        self.chunk_size: int = self.args.chunk or (self.model.cfg.context // 3)
+        # Relative paths are resolved from here instead of the current directory, but reported as given
+        self.cwd: str = cwd
+
+        # Outputs and events go to the sink, printed by default
+        self.sink: Sink = sink or PrintSink(self.args.json, self.args.format)
+
+        # Cascade: each chunk goes to the first model, escalated to the next one if it fails
+        self.models: List[Model] = [model] + list(escalation or ())
+
+        self.chunk_size: int = self.args.chunk or min(m.cfg.context // 3 for m in self.models)
         self.chunk_overlap: int = self.args.overlap
 
-        system: str = self.args.system
+        self.system: str = self.args.system
         if self.args.system_file:
             with open(self.args.system_file, 'rt', encoding='utf-8') as f:
-                system: str = f.read().strip()
+                self.system = f.read().strip()
 
-        prompt_tokens: int = count_tokens(self.model.cfg.prompt_template.format(system=system, instruction=''))
-        assert 0 < self.chunk_size <= self.model.cfg.context - prompt_tokens, f'Invalid chunk size: {self.chunk_size}'
-        assert 0 <= self.chunk_overlap < self.chunk_size, f'Invalid chunk overlap: {self.chunk_overlap}'
-
-        max_tokens: int = self.model.cfg.context - prompt_tokens - self.chunk_size if self.args.max_tokens is None else self.args.max_tokens
-        assert max_tokens > 0, f'Invalid max tokens: {max_tokens}'
+        # Leave room for the packing instructions in the system prompt
+        self.pack_size: int = self.args.pack
+        system: str = format_pack_system(self.system, self.pack_size) if self.pack_size > 1 else self.system
 
-        self.params: SamplingParams = SamplingParams(
-            n=self.args.number,
-            max_tokens=max_tokens,
-            **self.model.cfg.sampling_params_dict)
+        assert 0 <= self.chunk_overlap < self.chunk_size, f'Invalid chunk overlap: {self.chunk_overlap}'
 
-        if self.args.temperature is not None:
-            self.params.temperature = self.args.temperature
+        self.stages: List[Stage] = [self.create_stage(m, system) for m in self.models]
+
+        first = self.stages[0]
+        self.prompt_tokens: int = first.prompt_tokens
+        self.params: SamplingParams = first.params
+
+        # Outputs matching this regexp are not confident enough, escalated to the next model
+        assert not self.args.escalate or len(self.models) > 1, 'Escalation requires a cascade of models'
+        self.rx_escalate: Optional[re.Pattern] = re.compile(self.args.escalate) if self.args.escalate else None
+
+        # Map-reduce: the outputs of the chunks are reduced into a single answer instead of printing them
+        self.reducer: Optional[Reducer] = None
+        self.reduce_system: str = ''
+        self.reduce_prompt_tokens: int = 0
+        self.reduce_pending: int = 0
+        self.reduce_tasks: Set[Task] = set()
+        self.answered: bool = False
+        if self.args.reduce:
+            self.reduce_system = self.args.reduce_system or format_reduce_system(self.system)
+            self.reduce_prompt_tokens = self.model.tokenizer.count(self.model.cfg.prompt_template.format(system=self.reduce_system, instruction=''))
+            # The longer system prompt is taken from the room of the input
+            reduce_size = self.chunk_size - max(0, self.reduce_prompt_tokens - self.prompt_tokens)
+            assert reduce_size > 0, f'Reduce system prompt is too long: {self.reduce_prompt_tokens} tokens'
+            self.reducer = Reducer(reduce_size)
+
+        # Racing samples: each of them is a separate generation, the first valid one wins
+        self.race: Optional[str] = self.args.race
 
         self.rx_regexp: re.Pattern = re.compile(self.args.regexp) if self.args.regexp else None
 
-        self.parallel: int = max(1, self.args.parallel or self.model.cfg.parallel)
-        self.input_queue: Queue[Chunk] = Queue(self.parallel)
+        # Enough generators to keep all the models of the cascade busy
+        self.parallel: int = sum(stage.parallel for stage in self.stages)
+        # Generations waiting are dispatched in the order of the schedule, chosen from up to the lookahead
+        lookahead = self.args.lookahead or (self.parallel if self.args.schedule == 'fifo' else LOOKAHEAD_FACTOR * self.parallel)
+        assert lookahead > 0, f'Invalid lookahead: {lookahead}'
+        self.input_queue: DispatchQueue = DispatchQueue(lookahead, self.args.schedule, lambda item: item.tokens)
         self.output_queue: Queue[Chunk] = Queue(self.parallel)
-        self.semaphore = Semaphore(self.parallel)
         self.next_chunk_index = 0
+
+        # In-flight deduplication: duplicates waiting for the result by digest, results of the original chunks finished (without their input)
+        self.dedup: bool = self.args.dedup
+        self.duplicates: Dict[str, List[Chunk]] = {}
+        self.deduplicated: Dict[str, Chunk] = {}
+        self.dedup_count: int = 0
+
+        # Small chunks waiting to be packed into a single generation
+        self.pending_pack: List[Chunk] = []
+        self.pending_pack_tokens: int = 0
+        # Cheap local filtering of the files and chunks before the LLM
+        self.prefilter: Prefilter = Prefilter(
+            include=self.args.include_regexp,
+            exclude=self.args.exclude_regexp,
+            keywords=self.load_keywords(),
+            ignore_case=self.args.ignore_case,
+            max_line_length=self.args.max_line_length,
+            skip_binary=self.args.skip_binary,
+            skip_minified=self.args.skip_minified,
+            encoding=self.args.encoding)
+        self.skip_count: int = 0
+
+        self.file_count = 0
+        self.workers: int = max(1, self.args.workers)
+        self.executor: Optional[Executor] = None
         self.generation_count = 0
         self.failure_count = 0
         self.finished_reading = False
         self.abort: bool = False
         self.tasks: List[Task] = []
+        self.unordered: bool = self.args.unordered
+        self.reorder: ReorderBuffer[Chunk] = ReorderBuffer(self.args.reorder_window or 16 * self.parallel)
 
-        self.cost: int = 0
-        self.budget: Optional[int] = self.args.budget
+        # Generations are refused once their estimated cost would exceed the budget
+        self.budget: Budget = Budget(self.args.budget)
+        self.over_budget: bool = False
 
         self.dry = self.args.dry
         self.verbose = self.args.verbose > 0
         self.debug = self.args.verbose > 1
 
-        self.log_format = '%s' if self.args.json else self.args.format
+        # The cache may be shared with other processors, then it is left open
+        self.cache: Optional[ResultCache] = None
+        self.own_cache: bool = cache is None
+        if self.dry:
+            pass
+        elif cache is not None:
+            self.cache = cache
+        elif self.args.cache:
+            self.cache = ResultCache(self.args.cache_dir, self.args.cache_size, self.args.cache_age)
+
+        # Incremental processing: previous and next manifest, chunks printed and expected number of chunks per file
+        self.manifest: Optional[Manifest] = None
+        self.next_manifest: Optional[Manifest] = None
+        self.manifest_chunks: Dict[str, List[Tuple[int, ChunkEntry]]] = {}
+        self.manifest_chunk_counts: Dict[str, int] = {}
+        self.manifest_failed: Set[str] = set()
+        if self.args.incremental and not self.dry:
+            key = self.settings_key()
+            self.manifest = Manifest.load(self.args.incremental, key)
+            self.next_manifest = Manifest(key)
+
+        # Checkpoint journal of the chunks completed, the chunks resumed from it
+        self.journal: Optional[Journal] = None
+        self.resume_count: int = 0
+        assert self.args.journal or not self.args.resume, 'Resuming requires a journal'
+        if self.args.journal and not self.dry:
+            self.journal = Journal(self.args.journal, self.settings_key(), self.args.resume)
+
+        # Stage timings, throughput and queue depths, collected always, reported on request
+        self.metrics: Metrics = Metrics()
+        self.queued_at: Dict[int, float] = {}
+        self.emitted_at: Dict[int, float] = {}
+
+    def create_stage(self, model: Model, system: str) -> Stage:
+        prompt_tokens: int = model.tokenizer.count(model.cfg.prompt_template.format(system=system, instruction=''))
+        assert 0 < self.chunk_size <= model.cfg.context - prompt_tokens, f'Invalid chunk size for {model.cfg.id}: {self.chunk_size}'
+
+        max_tokens: int = model.cfg.context - prompt_tokens - self.chunk_size if self.args.max_tokens is None else self.args.max_tokens
+        assert max_tokens > 0, f'Invalid max tokens for {model.cfg.id}: {max_tokens}'
+
+        def sampling_params(n: int) -> SamplingParams:
+            params = SamplingParams(n=n, max_tokens=max_tokens, **model.cfg.sampling_params_dict)
+            if self.args.temperature is not None:
+                params.temperature = self.args.temperature
+            return params
+
+        # Racing samples are separate generations of a single output each,
+        # created from scratch, since best_of defaults to n and a copy would keep it
+        params: SamplingParams = sampling_params(self.args.number)
+        sample_params: SamplingParams = sampling_params(1)
+
+        parallel: int = max(1, self.args.parallel or model.cfg.parallel)
+        return Stage(model, prompt_tokens, params, sample_params, parallel, self.create_limiter(model, parallel))
+
+    def create_limiter(self, model: Model, parallel: int) -> Limiter:
+        if self.args.adaptive:
+            return AdaptiveLimiter(
+                min(parallel, max(1, self.args.min_parallel)),
+                parallel,
+                on_change=lambda limit: self.log_debug('CONCURRENCY', model=model.cfg.id, limit=limit))
+
+        return Limiter(parallel)
+
+    def cascade_key(self) -> tuple:
+        # Empty for a single model, so it does not invalidate the results cached without a cascade
+        if len(self.stages) < 2:
+            return ()
+        return tuple((stage.model.cfg.id, stage.model.cfg.prompt_template, vars(stage.params)) for stage in self.stages[1:]) + (self.args.escalate,)
+
+    def settings_key(self) -> str:
+        # Settings affecting the chunk boundaries and the outputs
+        return cache_key(
+            self.model.cfg.id,
+            self.model.cfg.prompt_template,
+            self.system,
+            vars(self.params),
+            self.args.validate,
+            self.args.regexp,
+            self.model.cfg.tokenizer,
+            self.args.encoding,
+            self.chunk_size,
+            self.chunk_overlap,
+            self.args.include_regexp,
+            self.args.exclude_regexp,
+            self.load_keywords(),
+            self.args.ignore_case,
+            self.args.max_line_length,
+            self.args.skip_binary,
+            self.args.skip_minified,
+            *self.cascade_key(),
+        )
+
+    def load_keywords(self) -> List[str]:
+        keywords: List[str] = list(self.args.keyword or ())
+        if self.args.keywords_file:
+            with open(self.args.keywords_file, 'rt', encoding='utf-8') as f:
+                keywords.extend(line.strip() for line in f if line.strip())
+        return keywords
 
     def log_event(self, event: str, **kws):
-        print(self.log_format % json.dumps(dict(event=event, **kws)))
+        self.sink.event(event, kws)
 
     def log_verbose(self, event: str, **kws):
         if self.verbose:
@@ -94,8 +301,22 @@ class Processor:
         if self.debug:
             self.log_event(event, **kws)
 
-    def check_finished(self, results):
-        if self.finished_reading and not self.generation_count and not results and self.input_queue.empty() and self.output_queue.empty():
+    def log_skipped(self, event: str, **kws):
+        # Skipped input is part of the machine readable output
+        if self.verbose or self.args.json:
+            self.log_event(event, **kws)
+
+    def check_finished(self):
+        # Over budget: stop once the generations in flight are finished and their results printed
+        if self.over_budget and not self.generation_count and self.output_queue.empty():
+            self.log_debug('FINISHED')
+            self.stop()
+            return
+
+        if self.reducer is not None and (self.reduce_pending or not self.reducer.finished):
+            return
+
+        if self.finished_reading and not self.generation_count and not self.reorder and self.input_queue.empty() and self.output_queue.empty():
             self.log_debug('FINISHED')
             self.stop()
 
@@ -103,29 +324,22 @@ class Processor:
         self.abort = True
         for task in self.tasks:
             task.cancel()
+        for task in self.reduce_tasks:
+            task.cancel()
 
-    async def process(self) -> bool:
+    async def process(self, inputs: Optional[Iterable[Union[str, Source]]] = None) -> bool:
+        """ Processes the paths (files, folders, glob patterns, - for stdin) and sources, the command line paths by default """
         self.log_debug('STARTED')
 
-        paths: Set[str] = {
-            os.path.normpath(path).replace('\\', '/')
-            for path in self.find_files()
-            if self.is_valid_file(path)
-        }
-
-        if not paths:
-            self.log_verbose('NO_FILES_FOUND')
-            return False
-
-        sorted_paths = sorted(paths)
-        del paths
-
-        self.log_debug('FILES_FOUND', count=len(sorted_paths), paths=sorted_paths)
-
         assert not self.tasks
 
+        if self.args.pool == 'process':
+            self.executor = ProcessPoolExecutor(self.workers)
+        else:
+            self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='aigrep-reader')
+
         self.tasks.extend([
-            asyncio.create_task(self.reader(sorted_paths)),
+            asyncio.create_task(self.reader(self.find_files(self.args.paths or ['-'] if inputs is None else inputs))),
             asyncio.create_task(self.printer()),
         ])
 
@@ -134,114 +348,751 @@ class Processor:
             for _ in range(self.parallel)
         )
 
+        if self.args.metrics or self.args.prometheus:
+            self.tasks.append(asyncio.create_task(self.sampler()))
+
         await asyncio.wait(self.tasks, return_when=asyncio.ALL_COMPLETED)
 
         self.tasks.clear()
 
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = None
+
+        if self.cache is not None:
+            self.log_verbose('CACHE', hits=self.cache.hits, misses=self.cache.misses)
+            if self.own_cache:
+                self.cache.close()
+
+        for model in self.models:
+            balancer = model.balancer
+            if model.transport.connections or balancer.retry_count or balancer.hedge_count:
+                self.log_verbose('TRANSPORT', model=model.cfg.id, connections=model.transport.connections,
+                                 retries=balancer.retry_count, hedges=balancer.hedge_count, hedge_wins=balancer.hedge_wins)
+
+        if len(self.stages) > 1:
+            self.log_verbose('CASCADE', models=[
+                dict(model=stage.model.cfg.id, answered=stage.answered, escalated=stage.escalated)
+                for stage in self.stages
+            ])
+
+        if self.journal is not None:
+            if self.resume_count:
+                self.log_verbose('RESUMED', path=self.args.journal, count=self.resume_count)
+            self.journal.close()
+
+        if self.args.prometheus:
+            self.metrics.write_prometheus(self.args.prometheus)
+
+        if self.args.metrics:
+            self.log_event('METRICS', **self.metrics.summary())
+
+        if not self.file_count:
+            self.log_verbose('NO_FILES_FOUND')
+            return False
+
+        if self.next_manifest is not None:
+            self.save_manifest()
+
+        if self.skip_count:
+            self.log_verbose('SKIPPED_CHUNKS', count=self.skip_count)
+
+        if self.dedup_count:
+            self.log_verbose('DEDUPLICATED', count=self.dedup_count)
+
         if self.failure_count:
             self.log_verbose('FAILED_CHUNKS', count=self.failure_count)
 
-        return self.failure_count == 0
+        return self.failure_count == 0 and not self.over_budget and not self.sink.closed
 
-    async def reader(self, paths: List[str]) -> None:
-        for path in paths:
-            self.log_debug('READER_FILE', path=path)
+    async def reader(self, inputs: AsyncIterator[Union[str, Source]]) -> None:
+        # Files are read and chunked ahead by the worker pool, their chunks are queued in order
+        pending: Deque[Future] = deque()
 
-            async for chunk in self.read_path(path):
-                if self.abort:
-                    return
-                self.log_debug('READER_CHUNK', index=chunk.index, path=chunk.path, lineno=chunk.lineno, lines=chunk.lines)
-                await self.input_queue.put(chunk)
+        try:
+            async for item in self.metrics.timed_iter('discovery', inputs):
+                self.log_debug('READER_FILE', path=item if isinstance(item, str) else item.name)
+                self.file_count += 1
+
+                if self.manifest is not None and isinstance(item, str) and item != '-':
+                    pending.append(asyncio.ensure_future(self.read_changed(item)))
+                else:
+                    pending.append(self.read_path(item))
+
+                if len(pending) > self.workers:
+                    await self.queue_file(pending.popleft())
+                    if self.abort:
+                        return
+
+            while pending:
+                await self.queue_file(pending.popleft())
                 if self.abort:
                     return
+        finally:
+            # Left over when stopped, the files being hashed or read are not waited for
+            for future in pending:
+                future.cancel()
 
+        await self.flush_pack()
+        if self.abort:
+            return
+
+        self.log_debug('FILES_FOUND', count=self.file_count)
         self.finished_reading = True
 
-    async def printer(self):
-        # Chunk reordering buffer
-        results: List[Optional[Chunk]] = []
-        first_index: int = 0
+        if self.reducer is not None:
+            self.dispatch_reduce(self.reducer.close(0, self.next_chunk_index))
+
+        self.check_finished()
+
+    async def read_changed(self, path: str) -> Union[FileEntry, FileChunks]:
+        # Touched files are hashed in a thread, which may take long for large files
+        entry = await asyncio.get_running_loop().run_in_executor(None, self.manifest.unchanged, path, self.local_path(path))
+        if entry is not None:
+            return entry
+        return await self.read_path(path)
+
+    def read_path(self, path: Union[str, Source]) -> Future:
+        loop = asyncio.get_running_loop()
+
+        # Sources are read in a thread, streams cannot be passed to another process
+        if isinstance(path, Source):
+            self.log_debug('READING_FILE', path=path.name)
+            return loop.run_in_executor(None, chunk_source, path, self.model.cfg.tokenizer, self.args.encoding, self.chunk_size, self.chunk_overlap, self.prefilter)
+
+        self.log_debug('READING_FILE', path=path)
+
+        if path == '-':
+            return loop.run_in_executor(None, chunk_stream, sys.stdin, self.model.cfg.tokenizer, self.chunk_size, self.chunk_overlap, self.prefilter)
+
+        return loop.run_in_executor(
+            self.executor, chunk_file,
+            self.local_path(path), self.model.cfg.tokenizer, self.args.encoding, self.chunk_size, self.chunk_overlap, self.next_manifest is not None, self.prefilter, path)
+
+    def read_next(self, result: FileChunks) -> Future:
+        loop = asyncio.get_running_loop()
+        position = result.position
+
+        # Streams are continued in the thread they can be read from, files in any worker
+        if result.stream:
+            return loop.run_in_executor(None, chunk_stream, position.stream, self.model.cfg.tokenizer, self.chunk_size, self.chunk_overlap, self.prefilter, result.path, position)
+
+        return loop.run_in_executor(
+            self.executor, chunk_file,
+            self.local_path(result.path), self.model.cfg.tokenizer, self.args.encoding, self.chunk_size, self.chunk_overlap, self.next_manifest is not None, self.prefilter, result.path, position)
+
+    async def queue_file(self, item: Future):
+        result: Union[FileEntry, FileChunks] = await item
+        if isinstance(result, FileEntry):
+            await self.replay_file(result)
+            return
+
+        path = result.path
+        self.metrics.observe('read_chunk', result.seconds)
+
+        if result.error == 'FAILED_TO_DECODE':
+            self.log_verbose(result.error, path=path, encoding=self.args.encoding)
+            return
+
+        if result.error in ('SKIP_BINARY', 'SKIP_MINIFIED'):
+            self.metrics.count('files_skipped')
+            self.log_skipped(result.error, path=path)
+            return
+
+        if result.error:
+            self.log_debug(result.error, path=path)
+            return
+
+        # Recorded before the chunks are printed, the number of chunks is known only after the last segment
+        entry: Optional[FileEntry] = None
+        if self.next_manifest is not None and not result.stream:
+            entry = self.next_manifest.files[path] = FileEntry(path, result.size, result.mtime, result.digest)
+
+        self.metrics.count('files_read')
+        chunk_count = 0
+        pending: Optional[Future] = None
+        try:
+            while 1:
+                for lineno, lines, reason in result.skipped:
+                    self.skip_count += 1
+                    self.log_skipped('SKIPPED', path=path, lineno=lineno, lines=lines, reason=reason)
+                self.metrics.count('chunks_skipped', len(result.skipped))
+
+                # The next segment is read while the chunks of this one are queued
+                if result.position is not None:
+                    pending = self.read_next(result)
+                elif entry is not None:
+                    entry.digest = result.digest
+                    self.manifest_chunk_counts[path] = chunk_count + len(result.chunks)
+
+                for lineno, text, tokens in result.chunks:
+                    await self.wait_for_slot()
+                    if self.abort:
+                        return
+
+                    chunk = Chunk(self.next_chunk_index, path, lineno, text.count('\n'), text, tokens=tokens)
+                    self.next_chunk_index += 1
+                    self.log_debug('READER_CHUNK', index=chunk.index, path=chunk.path, lineno=chunk.lineno, lines=chunk.lines, tokens=tokens)
+                    await self.queue_chunk(chunk)
+                    if self.abort:
+                        return
+
+                if pending is None:
+                    return
+
+                chunk_count += len(result.chunks)
+                result = await pending
+                pending = None
+                self.metrics.observe('read_chunk', result.seconds)
+
+                if result.error:
+                    # The chunks read before are processed, the file is left out of the manifest
+                    self.log_verbose(result.error, path=path, encoding=self.args.encoding)
+                    return
+        finally:
+            if pending is not None:
+                pending.cancel()
+
+    async def wait_for_slot(self):
+        # Backpressure: the next chunk must fit into the reorder window
+        if self.unordered or self.reorder.has_slot(self.next_chunk_index):
+            return
+
+        # Dispatch the chunks held back for packing, the printer may be waiting for them
+        await self.flush_pack()
+
+        self.log_debug('READER_WAITING', index=self.next_chunk_index)
+        await self.reorder.wait_for_slot(self.next_chunk_index)
+
+    async def queue_chunk(self, chunk: Chunk):
+        if self.dedup or self.journal is not None:
+            chunk.digest = text_digest(chunk.input)
+
+        if self.journal is not None and await self.resume_chunk(chunk):
+            return
+
+        if self.dedup:
+            # Identical chunks are generated only once
+            original = self.deduplicated.get(chunk.digest)
+            if original is not None:
+                self.dedup_count += 1
+                await self.emit_duplicate(chunk, original)
+                return
+
+            duplicates = self.duplicates.get(chunk.digest)
+            if duplicates is not None:
+                self.dedup_count += 1
+                duplicates.append(chunk)
+                return
+
+            self.duplicates[chunk.digest] = []
+
+        if self.pack_size < 2:
+            await self.put_input(chunk)
+            return
+
+        pending = self.pending_pack
+        if pending and (len(pending) >= self.pack_size or
+                        self.pending_pack_tokens + chunk.tokens + PACK_ITEM_TOKENS > self.chunk_size):
+            await self.flush_pack()
+
+        self.pending_pack.append(chunk)
+        self.pending_pack_tokens += chunk.tokens + PACK_ITEM_TOKENS
+
+    async def resume_chunk(self, chunk: Chunk) -> bool:
+        entry = self.journal.find(chunk.index, chunk.path, chunk.lineno, chunk.digest)
+        if entry is None:
+            return False
+
+        chunk.output = entry.output
+        chunk.successful = True
+        self.resume_count += 1
+        self.log_debug('READER_RESUMED', index=chunk.index, path=chunk.path, lineno=chunk.lineno, lines=chunk.lines)
+
+        # Identical chunks read later can reuse the result
+        if self.dedup and chunk.digest not in self.duplicates:
+            self.deduplicated.setdefault(chunk.digest, replace(chunk, input=''))
+
+        await self.put_output(chunk)
+        return True
+
+    async def flush_pack(self):
+        chunks = self.pending_pack
+        if not chunks:
+            return
+
+        self.pending_pack = []
+        self.pending_pack_tokens = 0
 
+        if len(chunks) == 1:
+            await self.put_input(chunks[0])
+        else:
+            await self.put_input(Pack(chunks))
+
+    async def put_input(self, item: Union[Chunk, Pack, ReduceBatch]):
+        self.queued_at[id(item)] = time.perf_counter()
+        await self.input_queue.put(item)
+
+    async def put_output(self, chunk: Chunk):
+        self.emitted_at[chunk.index] = time.perf_counter()
+        await self.output_queue.put(chunk)
+
+    async def replay_file(self, entry: FileEntry):
+        self.log_debug('READER_REPLAY', path=entry.path, chunks=len(entry.chunks))
+
+        self.next_manifest.files[entry.path] = entry
+        self.manifest_chunk_counts[entry.path] = len(entry.chunks)
+
+        for item in entry.chunks:
+            await self.wait_for_slot()
+            if self.abort:
+                return
+
+            chunk = Chunk(self.next_chunk_index, entry.path, item.lineno, item.lines, '', item.output, successful=True)
+            self.next_chunk_index += 1
+            await self.put_output(chunk)
+            if self.abort:
+                return
+
+    def record_manifest(self, chunk: Chunk):
+        entry = self.next_manifest.files.get(chunk.path)
+        if entry is None or not chunk.input:
+            return
+
+        if chunk.successful:
+            self.manifest_chunks.setdefault(chunk.path, []).append((chunk.index, ChunkEntry(chunk.lineno, chunk.lines, chunk.output)))
+        else:
+            self.manifest_failed.add(chunk.path)
+
+    def save_manifest(self):
+        manifest = self.next_manifest
+
+        # Chunks may have been printed out of order
+        for path, items in self.manifest_chunks.items():
+            entry = manifest.files.get(path)
+            if entry is not None:
+                entry.chunks = [item for _, item in sorted(items, key=lambda t: t[0])]
+
+        # Keep only the files completely and successfully processed
+        for path, entry in list(manifest.files.items()):
+            if path in self.manifest_failed or len(entry.chunks) != self.manifest_chunk_counts.get(path, -1):
+                del manifest.files[path]
+
+        manifest.save(self.args.incremental)
+        self.log_verbose('MANIFEST_SAVED', path=self.args.incremental, files=len(manifest.files))
+
+    async def printer(self):
         # Total number of outputs printed
         print_count: int = 0
         abort_at: Optional[int] = self.args.abort
 
         while not self.abort:
             chunk: Chunk = await self.output_queue.get()
-            assert chunk.index >= first_index
 
             self.log_debug('PRINTER_CHUNK', index=chunk.index, path=chunk.path, lineno=chunk.lineno, lines=chunk.lines, attempt=chunk.attempt)
 
-            # Reserve slots
-            while chunk.index - first_index >= len(results):
-                results.append(None)
-
-            # Store
-            results[chunk.index - first_index] = chunk
+            if self.unordered:
+                ready: Iterable[Chunk] = [chunk]
+            else:
+                self.reorder.put(chunk.index, chunk)
+                ready = self.reorder.pop_ready()
 
             # Output
-            while not self.abort and results and results[0]:
-                chunk: Chunk = results.pop(0)
-                first_index += 1
-
-                if chunk.successful:
-                    self.log_verbose('OUTPUT', index=chunk.index, path=chunk.path, lineno=chunk.lineno, lines=chunk.lines, attempt=chunk.attempt)
-                    if self.args.json:
-                        self.log_event('OUTPUT', **asdict(chunk))
-                    else:
-                        print(chunk.output)
+            for chunk in ready:
+                if self.abort:
+                    break
+
+                self.metrics.observe('reorder_wait', time.perf_counter() - self.emitted_at.pop(chunk.index))
+                self.metrics.count('chunks_printed')
+
+                if self.next_manifest is not None:
+                    self.record_manifest(chunk)
+
+                if self.reducer is not None:
+                    self.log_verbose('OUTPUT' if chunk.successful else 'FAILED', index=chunk.index, path=chunk.path, lineno=chunk.lineno, lines=chunk.lines, attempt=chunk.attempt)
+                    self.reduce(0, chunk.index, chunk.output if chunk.successful else None)
                 else:
-                    self.log_verbose('FAILED', index=chunk.index, path=chunk.path, lineno=chunk.lineno, lines=chunk.lines, attempt=chunk.attempt)
+                    if chunk.successful:
+                        self.log_verbose('OUTPUT', index=chunk.index, path=chunk.path, lineno=chunk.lineno, lines=chunk.lines, attempt=chunk.attempt)
+                    else:
+                        self.log_verbose('FAILED', index=chunk.index, path=chunk.path, lineno=chunk.lineno, lines=chunk.lines, attempt=chunk.attempt)
+                        self.metrics.count('chunks_failed')
+                    await self.sink.output(chunk)
 
                 print_count += 1
                 if abort_at is not None and print_count >= abort_at:
                     self.stop()
 
-            self.check_finished(results)
+            if self.sink.closed:
+                self.stop()
+                break
+
+            self.check_finished()
 
     async def generator(self):
         while not self.abort:
-            chunk: Chunk = await self.input_queue.get()
-            chunk.attempt += 1
+            item: Union[Chunk, Pack, ReduceBatch] = await self.input_queue.get()
+            self.metrics.observe('queue_wait', time.perf_counter() - self.queued_at.pop(id(item)))
 
             self.generation_count += 1
             try:
-                total_cost = 0
-                for attempt in range(self.args.attempts):
-                    chunk.attempt = 1 + attempt
-                    self.log_debug('GENERATOR_ATTEMPT', index=chunk.index, path=chunk.path, lineno=chunk.lineno, lines=chunk.lines, attempt=chunk.attempt)
+                if isinstance(item, Pack):
+                    await self.process_pack(item)
+                elif isinstance(item, ReduceBatch):
+                    await self.process_reduce(item)
+                else:
+                    await self.process_chunk(item)
+            except BudgetExceeded:
+                pass
+            finally:
+                self.generation_count -= 1
 
-                    async with self.semaphore:
-                        if self.dry:
-                            outputs = [(f'DRY RUN RESULT {1 + i}', 10) for i in range(self.params.n)]
-                        else:
-                            outputs = await self.model.generate(self.args.system, chunk.input, self.params)
+            if self.over_budget or isinstance(item, ReduceBatch):
+                self.check_finished()
+
+    async def process_chunk(self, chunk: Chunk):
+        if await self.finish_cached(chunk):
+            return
+
+        total_cost = 0
+        for i, stage in enumerate(self.stages):
+            if i:
+                self.log_debug('GENERATOR_ESCALATE', index=chunk.index, path=chunk.path, lineno=chunk.lineno, lines=chunk.lines, model=stage.model.cfg.id)
+                self.metrics.count('escalations')
+
+            tokens = self.stage_tokens(chunk, stage)
+            if tokens > self.chunk_size:
+                # Longer by the tokenizer of this model, it would not fit into its context
+                self.log_verbose('CHUNK_TOO_LONG', index=chunk.index, path=chunk.path, lineno=chunk.lineno, lines=chunk.lines, model=stage.model.cfg.id, tokens=tokens, chunk_size=self.chunk_size)
+                stage.escalated += 1
+                continue
 
-                    total_cost += sum(cost for text, cost in outputs)
+            # Outputs of the last model are accepted without the confidence check
+            confident = i + 1 < len(self.stages)
+            if self.race:
+                valid_outputs, cost = await self.race_samples(chunk, stage, tokens, confident)
+            else:
+                valid_outputs, cost = await self.generate_attempts(chunk, stage, tokens, confident)
+            total_cost += cost
+
+            if valid_outputs:
+                stage.answered += 1
+                chunk.model = stage.model.cfg.id
+                break
 
-                    valid_outputs = list(self.keep_valid_output(text for text, cost in outputs))
-                    if valid_outputs or self.dry:
+            stage.escalated += 1
+        else:
+            self.log_debug('GENERATOR_FAILED', index=chunk.index, path=chunk.path, lineno=chunk.lineno, lines=chunk.lines, attempt=chunk.attempt)
+            self.failure_count += 1
+            await self.emit(chunk)
+            return
+
+        await self.finish_chunk(chunk, valid_outputs, total_cost)
+
+    def stage_tokens(self, chunk: Chunk, stage: Stage) -> int:
+        # The chunks are cut by the tokenizer of the first model, counted again for a model with another one
+        if stage.model.tokenizer is self.model.tokenizer:
+            return chunk.tokens
+        return stage.model.tokenizer.count(chunk.input)
+
+    async def generate_attempts(self, chunk: Chunk, stage: Stage, tokens: int, confident: bool = False) -> Tuple[List[str], int]:
+        # Attempts one after the other, each of them generating --number outputs at once
+        total_cost = 0
+        for attempt in range(self.args.attempts):
+            chunk.attempt = 1 + attempt
+            self.log_debug('GENERATOR_ATTEMPT', index=chunk.index, path=chunk.path, lineno=chunk.lineno, lines=chunk.lines, attempt=chunk.attempt)
+
+            generation = await self.generate(self.system, chunk.input, stage.prompt_tokens + tokens, stage=stage)
+            total_cost += generation.cost
+
+            valid_outputs = self.validate_outputs(generation.outputs, confident)
+            if valid_outputs:
+                return valid_outputs, total_cost
+
+        return [], total_cost
+
+    async def race_samples(self, chunk: Chunk, stage: Stage, tokens: int, confident: bool = False) -> Tuple[List[str], int]:
+        # Up to --number samples in flight as separate generations, up to --number times --attempts in total.
+        # Each sample is validated as it arrives, the rest are cancelled as soon as there is a winner.
+        # The first valid sample wins, or with the ordered tie-break the valid sample started first.
+        width = self.args.number
+        total = width * self.args.attempts
+        started = 0
+        total_cost = 0
+
+        running: Dict[Task, int] = {}
+        results: Dict[int, Optional[str]] = {}
+        try:
+            while 1:
+                while len(running) < width and started < total:
+                    self.log_debug('GENERATOR_SAMPLE', index=chunk.index, path=chunk.path, lineno=chunk.lineno, lines=chunk.lines, sample=started)
+                    task = asyncio.create_task(self.generate(self.system, chunk.input, stage.prompt_tokens + tokens, stage.sample_params, stage))
+                    running[task] = started
+                    started += 1
+
+                if not running:
+                    return [], total_cost
+
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    sample = running.pop(task)
+                    generation: Generation = task.result()
+                    total_cost += generation.cost
+                    valid_outputs = self.validate_outputs(generation.outputs, confident)
+                    results[sample] = valid_outputs[0] if valid_outputs else None
+
+                # Samples finished, but not valid are left in the results as None
+                first_running = min(running.values(), default=total)
+                for sample in sorted(results):
+                    if self.race == 'ordered' and sample > first_running:
                         break
-                else:
-                    self.log_debug('GENERATOR_FAILED', index=chunk.index, path=chunk.path, lineno=chunk.lineno, lines=chunk.lines, attempt=chunk.attempt)
-                    self.failure_count += 1
-                    await self.output_queue.put(chunk)
+                    text = results[sample]
+                    if text is not None:
+                        chunk.attempt = 1 + sample // width
+                        self.log_debug('GENERATOR_RACE_WON', index=chunk.index, path=chunk.path, lineno=chunk.lineno, lines=chunk.lines, sample=sample, cancelled=len(running))
+                        return [text], total_cost
+        finally:
+            for task in running:
+                task.cancel()
+
+    def validate_outputs(self, outputs: List[str], confident: bool = False) -> List[str]:
+        with self.metrics.timer('validation'):
+            valid_outputs = list(self.keep_valid_output(outputs))
+            if confident:
+                valid_outputs = list(self.keep_confident_output(valid_outputs))
+
+        if not valid_outputs and self.dry:
+            valid_outputs = list(outputs)
+
+        return valid_outputs
+
+    async def process_pack(self, pack: Pack):
+        chunks = [chunk for chunk in pack.chunks if not await self.finish_cached(chunk)]
+        if len(chunks) < 2:
+            for chunk in chunks:
+                await self.process_chunk(chunk)
+            return
+
+        self.log_debug('GENERATOR_PACK', indices=[chunk.index for chunk in chunks], tokens=pack.tokens)
+
+        generation = await self.generate(
+            format_pack_system(self.system, len(chunks)),
+            format_pack_input([chunk.input for chunk in chunks]),
+            self.prompt_tokens + sum(chunk.tokens + PACK_ITEM_TOKENS for chunk in chunks))
+
+        # Valid answers for each chunk from all the outputs
+        candidates: List[List[str]] = [[] for _ in chunks]
+        with self.metrics.timer('validation'):
+            for text in generation.outputs:
+                answers = split_pack_output(text, len(chunks))
+                if answers is None:
                     continue
+                for i, answer in enumerate(answers):
+                    if answer is not None:
+                        candidates[i].extend(self.keep_confident_output(self.keep_valid_output([answer])))
+
+        # Distribute the cost evenly
+        share = generation.cost // len(chunks)
+
+        fallback: List[Chunk] = []
+        for chunk, valid_outputs in zip(chunks, candidates):
+            if valid_outputs:
+                chunk.attempt = 1
+                await self.finish_chunk(chunk, valid_outputs, share)
+            else:
+                fallback.append(chunk)
+
+        # Individual generations for the chunks without a valid answer
+        for chunk in fallback:
+            self.log_debug('GENERATOR_PACK_FALLBACK', index=chunk.index, path=chunk.path, lineno=chunk.lineno, lines=chunk.lines)
+            await self.process_chunk(chunk)
+
+    async def process_reduce(self, batch: ReduceBatch):
+        self.log_debug('GENERATOR_REDUCE', level=batch.level, index=batch.index, inputs=len(batch.inputs), tokens=batch.tokens)
+
+        text: Optional[str] = None
+        try:
+            instruction = format_reduce_input(batch.inputs)
+            for attempt in range(self.args.attempts):
+                generation = await self.generate(self.reduce_system, instruction, self.reduce_prompt_tokens + batch.tokens)
+                valid_outputs = self.validate_outputs(generation.outputs)
+                if valid_outputs:
+                    text = min(valid_outputs, key=len)
+                    break
+            else:
+                self.log_verbose('REDUCE_FAILED', level=batch.level, index=batch.index, inputs=len(batch.inputs))
+                self.failure_count += 1
+        finally:
+            self.reduce_pending -= 1
+
+        self.reduce(batch.level + 1, batch.index, text)
+
+    def reduce(self, level: int, index: int, text: Optional[str]):
+        tokens = 0 if text is None else self.model.tokenizer.count(text)
+        if tokens > self.reducer.output_limit:
+            # Cut at the first token not fitting
+            text = text[:self.model.tokenizer.token_offsets(text)[self.reducer.output_limit]]
+            self.log_verbose('REDUCE_TRUNCATED', level=level, index=index, tokens=tokens, limit=self.reducer.output_limit)
+            tokens = self.reducer.output_limit
+        self.dispatch_reduce(self.reducer.add(level, index, text, tokens))
+
+    def dispatch_reduce(self, batches: List[ReduceBatch]):
+        # Queued from separate tasks, since the printer and the generators must not block on the input queue
+        for batch in batches:
+            self.reduce_pending += 1
+            task = asyncio.create_task(self.put_input(batch))
+            self.reduce_tasks.add(task)
+            task.add_done_callback(self.reduce_tasks.discard)
+
+        if not self.reducer.finished or self.answered:
+            return
 
-                # Prefer the shortest valid output (likely that's the most concise)
-                valid_outputs.sort(key=lambda t: len(t))
-                chunk.output = valid_outputs[0]
-                chunk.successful = True
+        self.answered = True
+        if self.reducer.answer is None:
+            self.log_verbose('NO_ANSWER')
+        self.sink.answer(self.reducer.answer)
+
+    async def generate(self, system: str, instruction: str, input_tokens: int, params: Optional[SamplingParams] = None, stage: Optional[Stage] = None) -> Generation:
+        if stage is None:
+            stage = self.stages[0]
+        if params is None:
+            params = stage.params
+
+        # Reserve the worst case cost before starting (best_of sequences are generated), settle it with the actual cost afterwards
+        reserved = input_tokens + params.max_tokens * (params.best_of or params.n)
+        if not await self.budget.reserve(reserved):
+            self.refuse_over_budget()
+            raise BudgetExceeded()
+
+        cost = 0
+        try:
+            # Errors left after the retries of the transport fail only this attempt
+            try:
+                async with stage.limiter.slot() as slot:
+                    # Cancelled once sent (losing race samples): the server may have generated up to the reservation
+                    cost = reserved
+                    with self.metrics.timer('request'):
+                        if self.dry:
+                            outputs = [f'DRY RUN RESULT {1 + i}' for i in range(params.n)]
+                            generation = Generation(outputs, input_tokens, sum(stage.model.tokenizer.count(output) for output in outputs))
+                        else:
+                            generation = await stage.model.generate(system, instruction, params, input_tokens)
+                    slot.tokens = cost = generation.cost
+            except Exception as e:
+                cost = 0
+                self.metrics.count('request_errors')
+                self.log_verbose('GENERATOR_ERROR', error=f'{e.__class__.__name__}: {e}')
+                return Generation([], 0, 0)
+        finally:
+            await self.budget.settle(reserved, cost)
+
+        self.metrics.count('requests')
+        self.metrics.count('tokens_in', generation.prompt_tokens)
+        self.metrics.count('tokens_out', generation.output_tokens)
+        return generation
+
+    def refuse_over_budget(self):
+        if self.over_budget:
+            return
 
-                self.log_debug('GENERATOR_FINISHED', index=chunk.index, path=chunk.path, lineno=chunk.lineno, lines=chunk.lines, attempt=chunk.attempt, cost=total_cost)
-                await self.output_queue.put(chunk)
+        # No new generations from now, the ones in flight are finished
+        self.over_budget = True
+        self.log_verbose('OVER_BUDGET', cost=self.budget.spent, reserved=self.budget.reserved, budget=self.budget.limit)
 
-                self.cost += total_cost
-                if self.budget and self.cost > self.budget:
-                    self.stop()
-                    self.log_verbose('OVER_BUDGET', cost=self.cost, budget=self.budget)
-            finally:
-                self.generation_count -= 1
+    async def finish_cached(self, chunk: Chunk) -> bool:
+        if self.cache is None:
+            return False
+
+        cached = self.cache.get(self.cache_key(chunk))
+        if cached is None:
+            return False
+
+        chunk.output, cost = cached
+        chunk.successful = True
+        self.metrics.count('cache_hits')
+        self.log_debug('GENERATOR_CACHED', index=chunk.index, path=chunk.path, lineno=chunk.lineno, lines=chunk.lines, cost=cost)
+        await self.emit(chunk)
+        return True
+
+    async def finish_chunk(self, chunk: Chunk, valid_outputs: List[str], cost: int):
+        # Prefer the shortest valid output (likely that's the most concise)
+        valid_outputs.sort(key=lambda t: len(t))
+        chunk.output = valid_outputs[0]
+        chunk.successful = True
+
+        self.log_debug('GENERATOR_FINISHED', index=chunk.index, path=chunk.path, lineno=chunk.lineno, lines=chunk.lines, attempt=chunk.attempt, cost=cost)
+        await self.emit(chunk, cost)
+
+        if self.cache is not None:
+            self.cache.put(self.cache_key(chunk), chunk.output, cost)
+
+    async def emit(self, chunk: Chunk, cost: int = 0):
+        self.record_journal(chunk, cost)
+        await self.put_output(chunk)
+
+        if not self.dedup:
+            return
+
+        # Resolve the duplicates waiting for this result
+        duplicates = self.duplicates.pop(chunk.digest, None)
+        if duplicates is None:
+            return
+
+        self.deduplicated[chunk.digest] = replace(chunk, input='')
+        for duplicate in duplicates:
+            await self.emit_duplicate(duplicate, chunk)
+
+    async def emit_duplicate(self, duplicate: Chunk, chunk: Chunk):
+        duplicate.output = chunk.output
+        duplicate.successful = chunk.successful
+        duplicate.model = chunk.model
+        if not duplicate.successful:
+            self.failure_count += 1
+
+        self.log_debug('GENERATOR_DUPLICATE', index=duplicate.index, path=duplicate.path, lineno=duplicate.lineno, lines=duplicate.lines, original=chunk.index)
+        self.record_journal(duplicate, 0)
+        await self.put_output(duplicate)
+
+    def record_journal(self, chunk: Chunk, cost: int):
+        # Failed chunks are not recorded, so they are retried when resumed
+        if self.journal is None or not chunk.successful:
+            return
+
+        self.journal.record(JournalEntry(chunk.index, chunk.path, chunk.lineno, chunk.lines, chunk.digest, chunk.output, cost))
+
+    async def sampler(self):
+        # Samples the queue depths, concurrency and event loop lag, updates the Prometheus textfile
+        interval = 1.0
+        written = time.monotonic()
+        while not self.abort:
+            started = time.monotonic()
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+
+            metrics = self.metrics
+            metrics.sample('loop_lag_seconds', round(max(0.0, now - started - interval), 6))
+            metrics.sample('input_queue', self.input_queue.qsize())
+            metrics.sample('output_queue', self.output_queue.qsize())
+            metrics.sample('reorder_buffer', len(self.reorder))
+            metrics.sample('generations', self.generation_count)
+            metrics.sample('concurrency', sum(stage.limiter.active for stage in self.stages))
+            metrics.sample('concurrency_limit', sum(int(stage.limiter.limit) for stage in self.stages))
+
+            if self.args.prometheus and now - written >= self.args.prometheus_interval:
+                metrics.write_prometheus(self.args.prometheus)
+                written = now
+
+    def cache_key(self, chunk: Chunk) -> str:
+        return cache_key(
+            self.model.cfg.id,
+            self.model.cfg.prompt_template,
+            self.system,
+            chunk.input,
+            vars(self.params),
+            self.args.validate,
+            self.args.regexp,
+            self.pack_size,
+            *self.cascade_key(),
+        )
 
     def keep_valid_output(self, outputs: Iterable[str]) -> Iterable[str]:
         for text in outputs:
@@ -249,6 +1100,13 @@ class Processor:
             if valid:
                 yield text
 
+    def keep_confident_output(self, outputs: Iterable[str]) -> Iterable[str]:
+        for text in outputs:
+            if self.rx_escalate is not None and self.rx_escalate.search(text) is not None:
+                self.log_validation_error('SKIP_NOT_CONFIDENT', text)
+                continue
+            yield text
+
     def verify_fix_generation(self, text: str) -> Tuple[str, bool]:
         original = text
 
@@ -269,6 +1127,7 @@ class Processor:
                 return original, False
             return normalized, True
         elif validate == 'yaml':
+            import yaml
             normalized = extract_code_block(text, 'yaml').strip('\n')
             try:
                 yaml.safe_load(normalized)
@@ -277,6 +1136,7 @@ class Processor:
                 return original, False
             return normalized, True
         elif validate == 'toml':
+            import toml
             normalized = extract_code_block(text, 'toml').strip('\n')
             try:
                 toml.loads(normalized)
@@ -299,110 +1159,87 @@ class Processor:
             return
 
         self.log_event(event)
-        print(text)
+        self.sink.text(text)
 
-    def find_files(self) -> Iterable[str]:
-        for path in self.args.paths:
-            pattern = ''
-            if '*' in path or '?' in path:
-                top, pattern = os.path.split(path)
-            elif os.path.isdir(path):
-                top = path
-            elif os.path.isfile(path):
+    async def find_files(self, inputs: Iterable[Union[str, Source]]) -> AsyncIterator[Union[str, Source]]:
+        seen: Set[str] = set()
+        async for path in self.iter_paths(inputs):
+            if isinstance(path, Source):
                 yield path
                 continue
+            if path != '-':
+                path = os.path.normpath(path).replace('\\', '/')
+            if path not in seen:
+                seen.add(path)
+                yield path
+
+    async def iter_paths(self, inputs: Iterable[Union[str, Source]]) -> AsyncIterator[Union[str, Source]]:
+        for path in inputs:
+            if isinstance(path, Source) or path == '-':
+                yield path
+            elif '*' in path or '?' in path:
+                top, pattern = os.path.split(path)
+                async for file_path in self.iter_files(top or '.', pattern, set()):
+                    yield file_path
+            elif os.path.isdir(self.local_path(path)):
+                async for file_path in self.iter_files(path, '', set()):
+                    yield file_path
+            elif os.path.isfile(self.local_path(path)):
+                if not self.is_excluded(path):
+                    yield path
             else:
-                continue
-            yield from self.iter_files(top or '.', pattern)
+                self.log_debug('SKIP_NOT_A_FILE', path=path)
+
+    async def iter_files(self, top: str, pattern: str, visited: Set[Tuple[int, int]]) -> AsyncIterator[str]:
+        # Yields files in sorted order per directory as they are found,
+        # relies on the file type information cached in the directory entries
+        try:
+            # Listed in a thread, a large directory would hold up the generations
+            entries = await asyncio.get_running_loop().run_in_executor(None, self.scan_dir, top, visited)
+        except OSError:
+            self.log_debug('SKIP_NO_ACCESS', path=top)
+            return
 
-    def iter_files(self, top: str, pattern: str) -> Iterable[str]:
-        if self.args.recursive:
-            for dir_path, _, filenames in os.walk(top, followlinks=self.args.follow):
-                yield from self.iter_files_in_folder(dir_path, filenames, pattern)
-        else:
-            filenames = os.listdir(top)
-            yield from self.iter_files_in_folder(top, filenames, pattern)
+        for i, entry in enumerate(entries, 1):
+            # Long runs of entries not matching do not hold up the event loop either
+            if i % DISCOVERY_BATCH == 0:
+                await asyncio.sleep(0)
 
-    def iter_files_in_folder(self, dir_path: str, filenames: List[str], pattern: str) -> Iterable[str]:
-        for filename in filenames:
-            if pattern and not fnmatch.fnmatch(filename, pattern):
-                continue
-            path = os.path.join(dir_path, filename)
-            if not os.path.isfile(path):
-                continue
-            yield path
+            # Same as the path of the entry without a working directory set
+            path = os.path.join(top, entry.name)
+            try:
+                if entry.is_file():
+                    if pattern and not fnmatch.fnmatch(entry.name, pattern):
+                        continue
+                    if self.is_excluded(path):
+                        continue
+                    yield path
+                elif self.args.recursive and entry.is_dir(follow_symlinks=self.args.follow):
+                    async for file_path in self.iter_files(path, pattern, visited):
+                        yield file_path
+            except OSError:
+                self.log_debug('SKIP_NO_ACCESS', path=path)
 
-    def is_valid_file(self, path: str) -> bool:
-        if os.path.isdir(path) or not os.path.isfile(path) and not os.path.islink(path):
-            self.log_debug('SKIP_NOT_A_FILE', path=path)
-            return False
+    def scan_dir(self, top: str, visited: Set[Tuple[int, int]]) -> List[os.DirEntry]:
+        """ Entries of the directory sorted by name, none if already visited """
+        if self.args.follow:
+            # Protect against symlink loops
+            st = os.stat(self.local_path(top))
+            if (st.st_dev, st.st_ino) in visited:
+                return []
+            visited.add((st.st_dev, st.st_ino))
 
+        with os.scandir(self.local_path(top)) as it:
+            return sorted(it, key=lambda e: e.name)
+
+    def local_path(self, path: str) -> str:
+        return os.path.join(self.cwd, path) if self.cwd else path
+
+    def is_excluded(self, path: str) -> bool:
         if self.args.exclude:
             for pattern in self.args.exclude:
                 if fnmatch.fnmatch(path, pattern):
                     self.log_debug('SKIP_IN_EXCLUDE', path=path, pattern=pattern)
-                    return False
-
-        if sys.platform != 'win32':
-            if not os.access(path, os.R_OK, follow_symlinks=self.args.follow):
-                self.log_debug('SKIP_NO_ACCESS', path=path)
-                return False
-
-        return True
-
-    async def read_path(self, path: str) -> AsyncIterable[Chunk]:
-        self.log_debug('READING_FILE', path=path)
-
-        if path == '-':
-            async for lineno, text in self.read_file(sys.stdin):
-                yield Chunk(self.next_chunk_index, '-', lineno, text.count('\n'), text)
-                self.next_chunk_index += 1
-            return
-
-        with open(path, 'rt', encoding=self.args.encoding) as f:
-            try:
-                async for lineno, text in self.read_file(f):
-                    yield Chunk(self.next_chunk_index, path, lineno, text.count('\n'), text)
-                    self.next_chunk_index += 1
-            except UnicodeDecodeError:
-                self.log_verbose('FAILED_TO_DECODE', path=path, encoding=self.args.encoding)
-
-    async def read_file(self, f: TextIO) -> AsyncIterable[Tuple[int, str]]:
-        lines = []
-        tokens = 0
-        lineno = 1
-
-        for line in f:
-
-            line_tokens = count_tokens(line)
-            if tokens + line_tokens >= self.chunk_size:
-
-                # Trim lines longer than chunk size
-                if not tokens and line_tokens:
-                    line = line[:len(line) * self.chunk_size // line_tokens]
-                    line_tokens = count_tokens(line)
-                    while line and line_tokens and line_tokens > self.chunk_size:
-                        line = line[:len(line) * 95 // 100]
-                        line_tokens = count_tokens(line)
-
-                text = ''.join(lines)
-                if text.strip():
-                    yield lineno, text
-
-                if self.chunk_overlap:
-                    while lines and tokens > self.chunk_overlap:
-                        tokens -= count_tokens(lines[0])
-                        lineno += lines[0].count('\n')
-                        del lines[0]
-                else:
-                    lines.clear()
-                    tokens = 0
-                    lineno += text.count('\n')
-
-            lines.append(line)
-            tokens += line_tokens
+                    return True
 
-        if lines:
-            text = ''.join(lines)
-            if text.strip():
-                yield lineno, text
+        return False
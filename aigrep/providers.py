@@ -0,0 +1,100 @@
+""" LLM engine APIs
+
+Each provider sends the generations to a single server address over the
+transport shared by the model. The vLLM provider uses the /generate endpoint
+of the vLLM demo server, the OpenAI provider the completions endpoint of the
+OpenAI compatible servers (vLLM, TGI, llama.cpp, Ollama and hosted ones),
+which report the token usage as well.
+
+"""
+import os
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+from vllm_client.sampling_params import SamplingParams
+
+from aigrep.transport import Transport
+
+# Parameters of the OpenAI completions API, the rest are sent only if not the default (supported by vLLM)
+OPENAI_PARAMS = ('n', 'best_of', 'max_tokens', 'temperature', 'top_p', 'presence_penalty', 'frequency_penalty', 'stop', 'seed')
+EXTRA_PARAMS = ('top_k', 'use_beam_search', 'length_penalty', 'early_stopping', 'ignore_eos')
+DEFAULT_PARAMS: Dict[str, Any] = vars(SamplingParams())
+
+# Environment variable of the API key sent as a bearer token to the OpenAI compatible servers
+API_KEY_VARIABLE = 'OPENAI_API_KEY'
+
+
+@dataclass
+class Completion:
+    # Generated texts without the prompt
+    outputs: List[str]
+
+    # Token usage reported by the server, None if not reported
+    prompt_tokens: Optional[int] = None
+    output_tokens: Optional[int] = None
+
+
+class Provider:
+
+    def __init__(self, model: str, address: str, transport: Transport):
+        self.model: str = model
+        self.address: str = address
+        self.transport: Transport = transport
+
+    async def generate(self, prompt: str, params: SamplingParams) -> Completion:
+        raise NotImplementedError()
+
+
+class VllmProvider(Provider):
+
+    def __init__(self, model: str, address: str, transport: Transport):
+        super().__init__(model, address, transport)
+        url = address.rstrip('/')
+        self.url: str = url if url.endswith('/generate') else f'{url}/generate'
+
+    async def generate(self, prompt: str, params: SamplingParams) -> Completion:
+        response = await self.transport.post(self.url, dict(prompt=prompt, **vars(params)))
+
+        # The vLLM server returns the prompt followed by the generated text, but no token usage
+        return Completion([text[len(prompt):] for text in response['text']])
+
+
+class OpenAIProvider(Provider):
+
+    def __init__(self, model: str, address: str, transport: Transport):
+        super().__init__(model, address, transport)
+        url = address.rstrip('/')
+        self.url: str = url if url.endswith('/completions') else f'{url}/completions'
+
+    def format_payload(self, prompt: str, params: SamplingParams) -> Dict[str, Any]:
+        payload: Dict[str, Any] = dict(model=self.model, prompt=prompt)
+        values = vars(params)
+        for name in OPENAI_PARAMS:
+            if values[name] is not None and values[name] != []:
+                payload[name] = values[name]
+        for name in EXTRA_PARAMS:
+            if values[name] != DEFAULT_PARAMS[name]:
+                payload[name] = values[name]
+        return payload
+
+    async def generate(self, prompt: str, params: SamplingParams) -> Completion:
+        response = await self.transport.post(self.url, self.format_payload(prompt, params))
+
+        choices = sorted(response['choices'], key=lambda choice: choice.get('index', 0))
+        usage = response.get('usage') or {}
+        return Completion(
+            outputs=[choice['text'] for choice in choices],
+            prompt_tokens=usage.get('prompt_tokens'),
+            output_tokens=usage.get('completion_tokens'),
+        )
+
+
+PROVIDERS = {
+    'vllm': VllmProvider,
+    'openai': OpenAIProvider,
+}
+
+
+def api_headers(provider: str) -> Dict[str, str]:
+    api_key = os.environ.get(API_KEY_VARIABLE, '') if provider == 'openai' else ''
+    return {'Authorization': f'Bearer {api_key}'} if api_key else {}
@@ -0,0 +1,156 @@
+""" Reducing the outputs of all chunks into a single answer
+
+The outputs of the chunks are combined in a tree of reduce generations.
+The outputs of each level are batched in order to fit the context window,
+each batch is reduced by a generation into an output of the next level,
+until a single answer remains. Batches are formed as soon as the outputs
+preceding them are available, so reduction overlaps with the generations
+still running for the chunks.
+
+Outputs longer than half of the batch size are truncated, so any two of
+them fit into a batch. Every batch but the last one of a level has at least
+two outputs, which makes the number of outputs decrease on each level.
+A single output left over at the end of a level is promoted to the next
+level as it is, without a generation.
+
+"""
+from dataclasses import dataclass, field
+from typing import List, Dict, Optional, Tuple
+
+REDUCE_SYSTEM = '''\
+The input consists of partial answers, each of them starts with a line like "### PART 1".
+They were written for separate parts of a larger text following these instructions:
+
+{system}
+
+Combine the partial answers into a single answer to the above instructions for the whole text.
+Merge the duplicates, keep all the relevant information and follow the same output format.
+Do NOT write anything else.'''
+
+PART_DELIMITER = '### PART {number}\n'
+
+# Tokens reserved for the delimiter of each part
+PART_TOKENS = 8
+
+
+def format_reduce_system(system: str) -> str:
+    return REDUCE_SYSTEM.format(system=system)
+
+
+def format_reduce_input(texts: List[str]) -> str:
+    return ''.join(
+        PART_DELIMITER.format(number=1 + i) + text + ('' if text.endswith('\n') else '\n')
+        for i, text in enumerate(texts)
+    )
+
+
+@dataclass
+class ReduceBatch:
+    # Level of the outputs reduced (0: outputs of the chunks), index of the output produced on the next level
+    level: int
+    index: int
+    inputs: List[str]
+    tokens: int
+
+
+@dataclass
+class Level:
+    # Number of outputs on this level, None until known
+    total: Optional[int] = None
+
+    # Outputs arrived, but not consumed yet: text and number of tokens, None if failed
+    outputs: Dict[int, Optional[Tuple[str, int]]] = field(default_factory=dict)
+
+    # Index of the next output to consume
+    cursor: int = 0
+
+    # Batch being collected and the number of batches dispatched
+    batch: List[str] = field(default_factory=list)
+    batch_tokens: int = 0
+    batch_count: int = 0
+
+
+class Reducer:
+
+    def __init__(self, max_tokens: int):
+        assert max_tokens > 0, f'Invalid reduce input size: {max_tokens}'
+        self.max_tokens: int = max_tokens
+
+        # Maximum size of an output, so any two outputs fit into a batch
+        self.output_limit: int = max_tokens // 2 - PART_TOKENS
+        assert self.output_limit > 0, f'Reduce input size is too small: {max_tokens}'
+
+        self.levels: List[Level] = []
+        self.finished: bool = False
+        self.answer: Optional[str] = None
+
+    def level(self, level: int) -> Level:
+        while len(self.levels) <= level:
+            self.levels.append(Level())
+        return self.levels[level]
+
+    def add(self, level: int, index: int, text: Optional[str], tokens: int) -> List[ReduceBatch]:
+        """ Adds an output (truncated to the output limit), returns the batches ready to be reduced """
+        assert tokens <= self.output_limit, f'Output too long: {tokens} tokens'
+        lvl = self.level(level)
+        assert index >= lvl.cursor and index not in lvl.outputs, f'Duplicate output: level={level} index={index}'
+        lvl.outputs[index] = None if text is None else (text, tokens)
+        return self.advance(level)
+
+    def close(self, level: int, total: int) -> List[ReduceBatch]:
+        """ Sets the number of outputs on the level, returns the batches ready to be reduced """
+        lvl = self.level(level)
+        assert lvl.total is None, f'Level already closed: {level}'
+        lvl.total = total
+        return self.advance(level)
+
+    def advance(self, level: int) -> List[ReduceBatch]:
+        lvl = self.level(level)
+        batches: List[ReduceBatch] = []
+
+        # Consume the outputs in order, batch them to fit the context window
+        while lvl.cursor in lvl.outputs:
+            output = lvl.outputs.pop(lvl.cursor)
+            lvl.cursor += 1
+            if output is None:
+                continue
+
+            text, tokens = output
+            tokens += PART_TOKENS
+
+            # A batch holds at least two outputs, since both are below the output limit
+            if lvl.batch and lvl.batch_tokens + tokens > self.max_tokens:
+                batches.append(self.dispatch(level, lvl))
+
+            lvl.batch.append(text)
+            lvl.batch_tokens += tokens
+
+        if lvl.total is None or lvl.cursor < lvl.total:
+            return batches
+
+        # All the outputs of the level are consumed
+        if not lvl.batch_count and len(lvl.batch) < 2:
+            self.finished = True
+            self.answer = lvl.batch[0] if lvl.batch else None
+            return batches
+
+        if len(lvl.batch) == 1:
+            self.promote(level, lvl)
+        elif lvl.batch:
+            batches.append(self.dispatch(level, lvl))
+
+        return batches + self.close(level + 1, lvl.batch_count)
+
+    def promote(self, level: int, lvl: Level):
+        # Nothing to combine the leftover output with, it becomes the last output of the next level
+        self.level(level + 1).outputs[lvl.batch_count] = (lvl.batch[0], lvl.batch_tokens - PART_TOKENS)
+        lvl.batch = []
+        lvl.batch_tokens = 0
+        lvl.batch_count += 1
+
+    def dispatch(self, level: int, lvl: Level) -> ReduceBatch:
+        batch = ReduceBatch(level, lvl.batch_count, lvl.batch, lvl.batch_tokens)
+        lvl.batch = []
+        lvl.batch_tokens = 0
+        lvl.batch_count += 1
+        return batch
@@ -0,0 +1,46 @@
+""" Restoring the order of the chunks finished out of order
+
+The buffer holds the chunks finished ahead of the next one to print,
+keyed by their index. New chunks may enter the pipeline only within
+a window ahead of the next one to print, so a slow or retried chunk
+applies backpressure instead of letting the buffer grow without limit.
+
+"""
+import asyncio
+from typing import Dict, Iterator, TypeVar, Generic
+
+T = TypeVar('T')
+
+
+class ReorderBuffer(Generic[T]):
+
+    def __init__(self, window: int):
+        assert window > 0, f'Invalid reorder window: {window}'
+        self.window: int = window
+        self.next_index: int = 0
+        self.items: Dict[int, T] = {}
+        self.advanced = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def has_slot(self, index: int) -> bool:
+        return index < self.next_index + self.window
+
+    async def wait_for_slot(self, index: int):
+        while not self.has_slot(index):
+            self.advanced.clear()
+            await self.advanced.wait()
+
+    def put(self, index: int, item: T):
+        assert self.next_index <= index, f'Index already passed: {index}'
+        assert index not in self.items, f'Duplicate index: {index}'
+        self.items[index] = item
+
+    def pop_ready(self) -> Iterator[T]:
+        """ Yields the items in order as long as there is no gap """
+        while self.next_index in self.items:
+            item = self.items.pop(self.next_index)
+            self.next_index += 1
+            self.advanced.set()
+            yield item
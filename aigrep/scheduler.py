@@ -0,0 +1,107 @@
+""" Fair sharing of the generations between concurrent jobs
+
+The daemon runs the jobs of many clients against the same servers. The number of
+parallel generations of each model is limited globally, each job is limited by
+its own --parallel within that. Once the global limit is reached, a slot freed
+goes to the waiting job with the fewest generations running, so a job asking
+for a lot of parallel generations cannot starve the others.
+
+"""
+import asyncio
+from collections import deque
+from typing import Dict, Deque
+
+from aigrep.limiter import Limiter
+
+
+class FairScheduler:
+
+    def __init__(self, limit: int):
+        assert limit > 0, f'Invalid limit: {limit}'
+        self.limit: int = limit
+        self.active: int = 0
+
+        # Generations running and waiting per job, the jobs waiting in the order of arrival
+        self.running: Dict[int, int] = {}
+        self.waiting: Dict[int, Deque[asyncio.Future]] = {}
+
+    async def acquire(self, job: int):
+        if self.active < self.limit and not self.waiting:
+            self.grant(job)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.setdefault(job, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                self.forget(job, future)
+            else:
+                # Cancelled after the slot was granted
+                self.release(job)
+            raise
+
+    def release(self, job: int):
+        self.active -= 1
+        self.running[job] -= 1
+        if not self.running[job]:
+            del self.running[job]
+        self.wake()
+
+    def grant(self, job: int):
+        self.active += 1
+        self.running[job] = self.running.get(job, 0) + 1
+
+    def wake(self):
+        while self.active < self.limit and self.waiting:
+            # Ties are broken by the order of arrival
+            job = min(self.waiting, key=lambda j: self.running.get(j, 0))
+            future = self.waiting[job].popleft()
+            if not self.waiting[job]:
+                del self.waiting[job]
+            if future.done():
+                continue
+            self.grant(job)
+            future.set_result(None)
+
+    def forget(self, job: int, future: asyncio.Future):
+        waiting = self.waiting.get(job)
+        if waiting is None or future not in waiting:
+            return
+        waiting.remove(future)
+        if not waiting:
+            del self.waiting[job]
+
+
+class FairLimiter(Limiter):
+    """ Limit of a job within its fair share of the global limit
+
+    Holds a slot of the limiter of the job first, then a slot of the shared scheduler.
+    """
+
+    def __init__(self, limiter: Limiter, scheduler: FairScheduler, job: int):
+        # The limit and the number of generations running are those of the limiter of the job
+        self.limiter: Limiter = limiter
+        self.scheduler: FairScheduler = scheduler
+        self.job: int = job
+
+    @property
+    def limit(self) -> float:
+        return self.limiter.limit
+
+    @property
+    def active(self) -> int:
+        return self.limiter.active
+
+    async def acquire(self):
+        await self.limiter.acquire()
+        try:
+            await self.scheduler.acquire(self.job)
+        except asyncio.CancelledError:
+            await self.limiter.release(0.0, 0, False)
+            raise
+
+    async def release(self, latency: float, tokens: int, error: bool):
+        self.scheduler.release(self.job)
+        await self.limiter.release(latency, tokens, error)
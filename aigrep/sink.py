@@ -0,0 +1,122 @@
+""" Destinations of the outputs and events of the processor
+
+The processor does not print anything itself. The print sink writes to
+stdout as the command line tool does, the queue sink streams everything
+to the library API.
+
+"""
+import asyncio
+import json
+import os
+import sys
+from dataclasses import asdict
+from typing import Any, Dict, Optional
+
+
+class Sink:
+
+    # Set once nobody reads the outputs anymore, the processor stops then
+    closed: bool = False
+
+    async def output(self, chunk):
+        """ Chunk finished, called in input order unless unordered (also for the failed ones) """
+
+    def answer(self, text: Optional[str]):
+        """ Single answer reduced from the outputs of all chunks, None if there is none """
+
+    def event(self, event: str, data: Dict[str, Any]):
+        """ Log event """
+
+    def text(self, text: str):
+        """ Free form text following an event, like an invalid output in debug mode """
+
+    def flush(self):
+        """ Writes out what is buffered """
+
+
+class PrintSink(Sink):
+
+    def __init__(self, json_output: bool = False, log_format: str = '%s'):
+        self.json_output: bool = json_output
+        self.log_format: str = '%s' if json_output else log_format
+
+    async def output(self, chunk):
+        if not chunk.successful:
+            return
+
+        if self.json_output:
+            self.event('OUTPUT', asdict(chunk))
+        else:
+            self.write(chunk.output)
+
+    def answer(self, text: Optional[str]):
+        if text is None:
+            return
+
+        if self.json_output:
+            self.event('ANSWER', dict(output=text))
+        else:
+            self.write(text)
+
+    def event(self, event: str, data: Dict[str, Any]):
+        self.write(self.log_format % json.dumps(dict(event=event, **data)))
+
+    def text(self, text: str):
+        self.write(text)
+
+    def write(self, text: str):
+        if self.closed:
+            return
+        try:
+            print(text)
+        except BrokenPipeError:
+            self.discard()
+
+    def flush(self):
+        if self.closed:
+            return
+        try:
+            sys.stdout.flush()
+        except BrokenPipeError:
+            self.discard()
+
+    def discard(self):
+        # The reader is gone (like head): stdout goes to /dev/null, so what is left buffered does not fail at exit
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        os.close(devnull)
+        self.closed = True
+
+
+class QueueSink(Sink):
+    """ Queues the chunks, the answer and optionally the events as (event, data) to be consumed by another task
+
+    The number of chunks queued is limited, so a slow consumer holds up the processing instead of buffering
+    all the outputs. The end of the processing is marked by None.
+    """
+
+    def __init__(self, size: int = 0, events: bool = False):
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.slots: Optional[asyncio.Semaphore] = asyncio.Semaphore(size) if size else None
+        self.events: bool = events
+
+    async def get(self):
+        item = await self.queue.get()
+        if self.slots is not None and item is not None and not isinstance(item, tuple):
+            self.slots.release()
+        return item
+
+    async def output(self, chunk):
+        if self.slots is not None:
+            await self.slots.acquire()
+        self.queue.put_nowait(chunk)
+
+    def answer(self, text: Optional[str]):
+        self.queue.put_nowait(('ANSWER', dict(output=text)))
+
+    def event(self, event: str, data: Dict[str, Any]):
+        if self.events:
+            self.queue.put_nowait((event, data))
+
+    def close(self):
+        self.queue.put_nowait(None)
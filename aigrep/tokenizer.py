@@ -0,0 +1,106 @@
+""" Tokenizers
+
+Each model can have its own tokenizer configured, loaded from local files only:
+
+- Path of a HuggingFace `tokenizer.json` file or the folder containing it
+  (requires the `tokenizers` package)
+- `tiktoken:ENCODING` to use a tiktoken encoding, like `tiktoken:cl100k_base`
+
+The tiktoken encoding of gpt-3.5 is used as an approximation if no tokenizer is configured.
+
+tiktoken downloads its encodings on first use only, they are kept in ~/.aigrep/tiktoken
+instead of the temporary folder (unless TIKTOKEN_CACHE_DIR is set), so later runs
+do not depend on the network. Run `aigrep --test` once to fill the cache.
+
+Tokenizers are shared, each one is loaded only once per process.
+
+"""
+import os
+from typing import List, Dict
+
+DEFAULT_TOKENIZER = 'tiktoken:cl100k_base'
+
+TIKTOKEN_CACHE_DIR = '~/.aigrep/tiktoken'
+
+
+class Tokenizer:
+
+    def __init__(self, spec: str):
+        self.spec: str = spec
+
+    def encode(self, text: str) -> List[int]:
+        raise NotImplementedError()
+
+    def token_offsets(self, text: str) -> List[int]:
+        """ Character offset of the start of each token in the text """
+        raise NotImplementedError()
+
+    def count(self, text: str) -> int:
+        if not text.strip():
+            return 0
+
+        return len(self.encode(text))
+
+
+class TiktokenTokenizer(Tokenizer):
+
+    def __init__(self, spec: str, name: str):
+        super().__init__(spec)
+
+        if 'TIKTOKEN_CACHE_DIR' not in os.environ and 'DATA_GYM_CACHE_DIR' not in os.environ:
+            # Inherited by the worker processes
+            os.environ['TIKTOKEN_CACHE_DIR'] = os.path.expanduser(TIKTOKEN_CACHE_DIR)
+
+        import tiktoken
+        self.encoding = tiktoken.get_encoding(name)
+
+    def encode(self, text: str) -> List[int]:
+        return self.encoding.encode(text, disallowed_special=())
+
+    def token_offsets(self, text: str) -> List[int]:
+        _, offsets = self.encoding.decode_with_offsets(self.encode(text))
+        return offsets
+
+
+class HuggingFaceTokenizer(Tokenizer):
+
+    def __init__(self, spec: str, path: str):
+        super().__init__(spec)
+
+        try:
+            from tokenizers import Tokenizer as HfTokenizer
+        except ImportError:
+            raise ValueError(f'Install the tokenizers package to use this tokenizer: {spec}')
+
+        if os.path.isdir(path):
+            path = os.path.join(path, 'tokenizer.json')
+
+        self.tokenizer = HfTokenizer.from_file(path)
+
+    def encode(self, text: str) -> List[int]:
+        return self.tokenizer.encode(text, add_special_tokens=False).ids
+
+    def token_offsets(self, text: str) -> List[int]:
+        return [start for start, _ in self.tokenizer.encode(text, add_special_tokens=False).offsets]
+
+
+TOKENIZERS: Dict[str, Tokenizer] = {}
+
+
+def load_tokenizer(spec: str) -> Tokenizer:
+    spec = spec or DEFAULT_TOKENIZER
+
+    tokenizer = TOKENIZERS.get(spec)
+    if tokenizer is not None:
+        return tokenizer
+
+    if spec.startswith('tiktoken:'):
+        tokenizer = TiktokenTokenizer(spec, spec[len('tiktoken:'):])
+    else:
+        path = os.path.expanduser(spec)
+        if not os.path.exists(path):
+            raise ValueError(f'Tokenizer not found: {spec}')
+        tokenizer = HuggingFaceTokenizer(spec, path)
+
+    TOKENIZERS[spec] = tokenizer
+    return tokenizer
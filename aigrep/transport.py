@@ -0,0 +1,66 @@
+""" HTTP transport shared by the generations of a model
+
+A single client session with a keep-alive connection pool is used for all the
+generations of a model, so the connections to the servers are reused instead
+of connecting for each request. The pool is sized to the number of parallel
+generations, so requests do not wait for each other for a connection.
+
+Idle connections are closed shortly before the servers would close them
+(uvicorn closes them after 5 seconds), otherwise a request sent over a
+connection just closed by the server fails.
+
+"""
+import asyncio
+from typing import Any, Dict, Optional
+
+import aiohttp
+
+# Seconds to keep idle connections open
+KEEPALIVE_TIMEOUT = 4.0
+
+
+class Transport:
+
+    def __init__(self, limit: int, connect_timeout: float = 0.0, read_timeout: float = 0.0, headers: Optional[Dict[str, str]] = None):
+        """ Limit: maximum number of connections; timeouts: seconds to connect and between reads of the response (0: no limit) """
+        assert limit > 0, f'Invalid connection limit: {limit}'
+        assert connect_timeout >= 0.0, f'Invalid connect timeout: {connect_timeout}'
+        assert read_timeout >= 0.0, f'Invalid read timeout: {read_timeout}'
+
+        self.limit: int = limit
+        self.headers: Dict[str, str] = headers or {}
+
+        # The generation as a whole is limited by the timeout of the balancer
+        self.timeout = aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout or None, sock_read=read_timeout or None)
+
+        # Created on first use, the session is bound to the event loop running
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+        # Connections opened, to verify they are reused
+        self.connections: int = 0
+
+    def get_session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        if self.session is None or self.session.closed or self.loop is not loop:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=0, keepalive_timeout=KEEPALIVE_TIMEOUT)
+            trace = aiohttp.TraceConfig()
+            trace.on_connection_create_end.append(self.on_connection_created)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout, headers=self.headers, trace_configs=[trace])
+            self.loop = loop
+        return self.session
+
+    async def on_connection_created(self, session, context, params):
+        self.connections += 1
+
+    async def post(self, url: str, payload: Dict[str, Any]) -> Any:
+        """ Posts the payload as JSON, returns the JSON response, raises aiohttp.ClientResponseError on HTTP errors """
+        async with self.get_session().post(url, json=payload) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+            self.loop = None
@@ -1,24 +1,4 @@
-# FIXME: Use the right tokenizer for the selected model
-import json
-import mimetypes
-from typing import List
-
-import tiktoken
-
-ENCODING = tiktoken.encoding_for_model('gpt-3.5-turbo')
-
-
-# FIXME: This is a good approximation for now
-def count_tokens(text: str) -> int:
-    if not text.strip():
-        return 0
-
-    tokens: List[int] = ENCODING.encode(
-        text,
-        disallowed_special=()
-    )
-
-    return len(tokens)
+import hashlib
 
 
 def extract_code_block(text: str, format: str) -> str:
@@ -35,3 +15,18 @@ def extract_code_block(text: str, format: str) -> str:
         return st.strip('`')
 
     return text
+
+
+def text_digest(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def file_digest(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while 1:
+            data = f.read(1 << 20)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
@@ -0,0 +1,89 @@
+""" Synthetic corpora for benchmarking
+
+Deterministic, so the results of subsequent runs are comparable.
+
+"""
+import os
+import random
+from typing import List
+
+WORDS: List[str] = '''
+    def class return import from self value index count result error path line chunk token model
+    async await yield lambda None True False if else elif for while with try except finally raise
+'''.split()
+
+
+def random_line(rng: random.Random, words: int) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def write_lines(path: str, rng: random.Random, lines: int, words: int):
+    with open(path, 'wt', encoding='utf-8') as f:
+        for i in range(lines):
+            f.write(f'{i:>6} {random_line(rng, rng.randint(1, 2 * words))}\n')
+
+
+def many_small_files(folder: str, count: int = 2000, lines: int = 20, seed: int = 0):
+    """ Lots of small source files in nested folders, one chunk each """
+    rng = random.Random(seed)
+    for i in range(count):
+        subfolder = os.path.join(folder, f'd{i // 100:03d}')
+        os.makedirs(subfolder, exist_ok=True)
+        write_lines(os.path.join(subfolder, f'f{i:05d}.py'), rng, lines, 6)
+
+
+def few_huge_files(folder: str, count: int = 2, size: int = 4 << 20, seed: int = 0):
+    """ A few large files of many short lines, lots of chunks per file """
+    rng = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    for i in range(count):
+        with open(os.path.join(folder, f'huge{i}.log'), 'wt', encoding='utf-8') as f:
+            written = 0
+            lineno = 0
+            while written < size:
+                line = f'{lineno:>8} {random_line(rng, rng.randint(4, 16))}\n'
+                f.write(line)
+                written += len(line)
+                lineno += 1
+
+
+def mixed_sizes(folder: str, count: int = 400, lines: int = 5, size: int = 64 << 10, seed: int = 0):
+    """ Small files followed by a large one, the chunks of which are much longer than the rest """
+    rng = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    for i in range(count):
+        write_lines(os.path.join(folder, f'f{i:05d}.py'), rng, lines, 6)
+
+    with open(os.path.join(folder, 'z_large.log'), 'wt', encoding='utf-8') as f:
+        written = 0
+        lineno = 0
+        while written < size:
+            line = f'{lineno:>8} {random_line(rng, rng.randint(4, 16))}\n'
+            f.write(line)
+            written += len(line)
+            lineno += 1
+
+
+def long_lines(folder: str, count: int = 10, lines: int = 10, length: int = 100000, seed: int = 0):
+    """ Minified-like files with lines longer than a chunk, which must be split """
+    rng = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    for i in range(count):
+        with open(os.path.join(folder, f'min{i:03d}.js'), 'wt', encoding='utf-8') as f:
+            for _ in range(lines):
+                parts: List[str] = []
+                size = 0
+                while size < length:
+                    part = f'{rng.choice(WORDS)}({rng.randint(0, 9999)});'
+                    parts.append(part)
+                    size += len(part)
+                f.write(''.join(parts))
+                f.write('\n')
+
+
+CORPORA = {
+    'many_small_files': many_small_files,
+    'few_huge_files': few_huge_files,
+    'long_lines': long_lines,
+    'mixed_sizes': mixed_sizes,
+}
@@ -0,0 +1,196 @@
+""" Local stand-in for the vLLM /generate and the OpenAI compatible /v1/completions endpoints
+
+Answers without a GPU, so the overhead of aigrep itself can be measured.
+The latency, the shared generation throughput, the rate of failures and
+the size of the output are configurable. The number of requests and of the
+connections opened are reported by /stats.
+
+Usage: python benchmarks/mock_server.py --port 8000 --latency 0.2 --throughput 5000
+
+"""
+import asyncio
+import random
+import time
+import weakref
+from argparse import ArgumentParser
+from dataclasses import dataclass
+from typing import List, Optional
+
+from aiohttp import web
+
+
+@dataclass
+class ServerConfig:
+    # Fixed part of the latency of each request in seconds
+    latency: float = 0.05
+
+    # Distribution of the random part of the latency: fixed, uniform, exponential or lognormal
+    distribution: str = 'exponential'
+
+    # Mean of the random part of the latency in seconds
+    jitter: float = 0.05
+
+    # Seconds per prompt token (word) added to the latency, so long prompts take longer
+    prefill: float = 0.0
+
+    # Output tokens generated per second shared by all requests (0: unlimited)
+    throughput: float = 0.0
+
+    # Maximum number of requests processed at once, the rest are waiting (0: unlimited)
+    concurrency: int = 0
+
+    # Probability of answering with HTTP 500
+    failure_rate: float = 0.0
+
+    # Number of tokens (words) generated per output
+    output_tokens: int = 32
+
+    # Random seed for reproducible runs
+    seed: Optional[int] = None
+
+
+class MockServer:
+
+    def __init__(self, cfg: ServerConfig):
+        assert cfg.latency >= 0.0, f'Invalid latency: {cfg.latency}'
+        assert cfg.jitter >= 0.0, f'Invalid jitter: {cfg.jitter}'
+        assert cfg.distribution in ('fixed', 'uniform', 'exponential', 'lognormal'), f'Invalid distribution: {cfg.distribution}'
+        assert cfg.prefill >= 0.0, f'Invalid prefill: {cfg.prefill}'
+        assert cfg.throughput >= 0.0, f'Invalid throughput: {cfg.throughput}'
+        assert cfg.concurrency >= 0, f'Invalid concurrency: {cfg.concurrency}'
+        assert 0.0 <= cfg.failure_rate <= 1.0, f'Invalid failure rate: {cfg.failure_rate}'
+        assert cfg.output_tokens >= 0, f'Invalid output tokens: {cfg.output_tokens}'
+
+        self.cfg: ServerConfig = cfg
+        self.random = random.Random(cfg.seed)
+        self.semaphore: Optional[asyncio.Semaphore] = None
+
+        # Time the shared generation capacity becomes free again
+        self.busy_until: float = 0.0
+
+        self.requests: int = 0
+        self.failures: int = 0
+
+        # Connections seen, to measure the connection reuse of the clients
+        self.transports = weakref.WeakSet()
+        self.connections: int = 0
+
+    def create_app(self) -> web.Application:
+        app = web.Application(client_max_size=1 << 26)
+        app.router.add_post('/generate', self.handle_generate)
+        app.router.add_post('/v1/completions', self.handle_completions)
+        app.router.add_get('/stats', self.handle_stats)
+        return app
+
+    async def handle_generate(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        prompt: str = payload['prompt']
+        outputs = await self.limit_generate(request, prompt, payload.get('n') or 1)
+
+        # vLLM returns the prompt followed by the generated text
+        return web.json_response(dict(text=[prompt + output for output in outputs]))
+
+    async def handle_completions(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        prompt: str = payload['prompt']
+        outputs = await self.limit_generate(request, prompt, payload.get('n') or 1)
+
+        return web.json_response(dict(
+            object='text_completion',
+            model=payload.get('model', ''),
+            choices=[dict(index=i, text=output, finish_reason='length') for i, output in enumerate(outputs)],
+            usage=dict(
+                prompt_tokens=len(prompt.split()),
+                completion_tokens=len(outputs) * self.cfg.output_tokens,
+                total_tokens=len(prompt.split()) + len(outputs) * self.cfg.output_tokens,
+            ),
+        ))
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(dict(requests=self.requests, failures=self.failures, connections=self.connections))
+
+    async def limit_generate(self, request: web.Request, prompt: str, n: int) -> List[str]:
+        self.requests += 1
+
+        if request.transport is not None and request.transport not in self.transports:
+            self.transports.add(request.transport)
+            self.connections += 1
+
+        if self.semaphore is None and self.cfg.concurrency:
+            self.semaphore = asyncio.Semaphore(self.cfg.concurrency)
+
+        if self.semaphore is None:
+            return await self.generate(len(prompt.split()), n)
+
+        async with self.semaphore:
+            return await self.generate(len(prompt.split()), n)
+
+    async def generate(self, prompt_tokens: int, n: int) -> List[str]:
+        await asyncio.sleep(self.cfg.latency + self.sample_jitter() + prompt_tokens * self.cfg.prefill)
+
+        if self.cfg.throughput:
+            # The outputs are generated one after the other at the throughput configured
+            now = time.monotonic()
+            self.busy_until = max(now, self.busy_until) + n * self.cfg.output_tokens / self.cfg.throughput
+            await asyncio.sleep(self.busy_until - now)
+
+        if self.random.random() < self.cfg.failure_rate:
+            self.failures += 1
+            raise web.HTTPInternalServerError(text='Simulated failure')
+
+        return [self.format_output(i) for i in range(n)]
+
+    def sample_jitter(self) -> float:
+        mean = self.cfg.jitter
+        if not mean:
+            return 0.0
+
+        distribution = self.cfg.distribution
+        if distribution == 'fixed':
+            return mean
+        if distribution == 'uniform':
+            return self.random.uniform(0.0, 2.0 * mean)
+        if distribution == 'exponential':
+            return self.random.expovariate(1.0 / mean)
+
+        # Lognormal with a heavy tail, sigma=1 gives the mean requested
+        return self.random.lognormvariate(0.0, 1.0) * mean / 1.6487
+
+    def format_output(self, index: int) -> str:
+        return ' '.join(f'word{(index + i) % 100}' for i in range(self.cfg.output_tokens))
+
+
+def create_argument_parser() -> ArgumentParser:
+    parser = ArgumentParser(description='Mock LLM server for benchmarking aigrep')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on')
+    parser.add_argument('--latency', type=float, default=ServerConfig.latency, help='Fixed part of the latency of each request in seconds')
+    parser.add_argument('--distribution', choices=('fixed', 'uniform', 'exponential', 'lognormal'), default=ServerConfig.distribution, help='Distribution of the random part of the latency')
+    parser.add_argument('--jitter', type=float, default=ServerConfig.jitter, help='Mean of the random part of the latency in seconds')
+    parser.add_argument('--prefill', type=float, default=ServerConfig.prefill, help='Seconds per prompt token (word) added to the latency')
+    parser.add_argument('--throughput', type=float, default=ServerConfig.throughput, help='Output tokens generated per second shared by all requests (0: unlimited)')
+    parser.add_argument('--concurrency', type=int, default=ServerConfig.concurrency, help='Maximum number of requests processed at once (0: unlimited)')
+    parser.add_argument('--failure-rate', type=float, default=ServerConfig.failure_rate, help='Probability of answering with HTTP 500')
+    parser.add_argument('--output-tokens', type=int, default=ServerConfig.output_tokens, help='Number of tokens generated per output')
+    parser.add_argument('--seed', type=int, help='Random seed')
+    return parser
+
+
+def main():
+    args = create_argument_parser().parse_args()
+    cfg = ServerConfig(
+        latency=args.latency,
+        distribution=args.distribution,
+        jitter=args.jitter,
+        prefill=args.prefill,
+        throughput=args.throughput,
+        concurrency=args.concurrency,
+        failure_rate=args.failure_rate,
+        output_tokens=args.output_tokens,
+        seed=args.seed,
+    )
+    web.run_app(MockServer(cfg).create_app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,274 @@
+""" Benchmarking the processing pipeline against a local mock vLLM server
+
+Measures the overhead of aigrep itself (discovery, chunking, scheduling, printing)
+without a GPU. Each scenario runs in a separate process, so the peak memory is
+measured per scenario. The server is started separately for each scenario.
+
+Usage: python benchmarks/run.py [--scenario NAME ...] [--save results.json] [--baseline results.json]
+
+Exits with an error if the throughput dropped or the memory use grew beyond the
+tolerance relative to the baseline results given.
+
+"""
+import asyncio
+import contextlib
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser, SUPPRESS
+from dataclasses import dataclass, field, asdict
+from typing import List, Dict, Any, Optional
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+# Same imports as the command line tool
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'aigrep'))
+
+from benchmarks.corpus import CORPORA
+from benchmarks.mock_server import ServerConfig
+
+# Interval of the event loop lag measurement in seconds
+LAG_INTERVAL = 0.01
+
+
+@dataclass
+class Scenario:
+    name: str
+    corpus: str
+    server: ServerConfig
+    argv: List[str] = field(default_factory=list)
+    parallel: int = 64
+    provider: str = 'vllm'
+
+
+SCENARIOS: List[Scenario] = [
+    Scenario('many_small_files', 'many_small_files', ServerConfig(latency=0.02, jitter=0.02, output_tokens=16, seed=0)),
+    Scenario('many_small_files_packed', 'many_small_files', ServerConfig(latency=0.02, jitter=0.02, output_tokens=16, seed=0), ['--pack', '16']),
+    Scenario('few_huge_files', 'few_huge_files', ServerConfig(latency=0.02, jitter=0.02, output_tokens=16, seed=0)),
+    Scenario('long_lines', 'long_lines', ServerConfig(latency=0.02, jitter=0.02, output_tokens=16, seed=0)),
+    Scenario('many_small_files_openai', 'many_small_files', ServerConfig(latency=0.02, jitter=0.02, output_tokens=16, seed=0), provider='openai'),
+    Scenario('mixed_sizes', 'mixed_sizes', ServerConfig(latency=0.02, jitter=0.02, prefill=0.001, output_tokens=16, seed=0), parallel=32),
+    Scenario('mixed_sizes_longest', 'mixed_sizes', ServerConfig(latency=0.02, jitter=0.02, prefill=0.001, output_tokens=16, seed=0), ['--schedule', 'longest'], parallel=32),
+    Scenario('throughput_limited', 'many_small_files', ServerConfig(latency=0.02, jitter=0.05, distribution='lognormal', throughput=50000, concurrency=32, output_tokens=64, seed=0)),
+]
+
+SCENARIO_MAP: Dict[str, Scenario] = {s.name: s for s in SCENARIOS}
+
+
+def find_free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while 1:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1.0):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+@contextlib.contextmanager
+def mock_server(cfg: ServerConfig):
+    port = find_free_port()
+    command = [
+        sys.executable, os.path.join(BENCHMARKS_DIR, 'mock_server.py'),
+        '--port', str(port),
+        '--latency', str(cfg.latency),
+        '--distribution', cfg.distribution,
+        '--jitter', str(cfg.jitter),
+        '--prefill', str(cfg.prefill),
+        '--throughput', str(cfg.throughput),
+        '--concurrency', str(cfg.concurrency),
+        '--failure-rate', str(cfg.failure_rate),
+        '--output-tokens', str(cfg.output_tokens),
+    ]
+    if cfg.seed is not None:
+        command.extend(['--seed', str(cfg.seed)])
+
+    process = subprocess.Popen(command)
+    try:
+        wait_for_port(port)
+        yield f'http://127.0.0.1:{port}'
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def prepare_corpus(work_dir: str, name: str) -> str:
+    folder = os.path.join(work_dir, name)
+    marker = os.path.join(folder, '.complete')
+    if not os.path.exists(marker):
+        CORPORA[name](folder)
+        with open(marker, 'wt'):
+            pass
+    return folder
+
+
+async def measure_lag(lags: List[float]):
+    while 1:
+        started = time.perf_counter()
+        await asyncio.sleep(LAG_INTERVAL)
+        lags.append(max(0.0, time.perf_counter() - started - LAG_INTERVAL))
+
+
+def peak_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS, in kilobytes elsewhere
+    return rss / (1 << 20) if sys.platform == 'darwin' else rss / 1024
+
+
+async def run_processor(scenario: Scenario, address: str, corpus_dir: str, tokenizer: str) -> Dict[str, Any]:
+    from aigrep.arguments import create_argument_parser
+    from aigrep.config import DEFAULT_CONFIG
+    from aigrep.model import Model
+    from aigrep.processor import Processor
+    from arguments import ArgsNamespace
+
+    config = DEFAULT_CONFIG.clone()
+    cfg = config.models[0]
+    cfg.provider = scenario.provider
+    cfg.address = f'{address}/v1' if scenario.provider == 'openai' else address
+    cfg.parallel = scenario.parallel
+    cfg.tokenizer = tokenizer
+
+    ns = create_argument_parser().parse_args(scenario.argv + ['--recursive', corpus_dir])
+    args = ArgsNamespace.from_args(ns)
+    model = Model(cfg)
+    processor = Processor(args, config, model)
+
+    lags: List[float] = []
+    lag_task = asyncio.create_task(measure_lag(lags))
+
+    started = time.perf_counter()
+    with open(os.devnull, 'wt') as devnull, contextlib.redirect_stdout(devnull):
+        ok = await processor.process()
+    elapsed = time.perf_counter() - started
+    await model.close()
+
+    lag_task.cancel()
+
+    metrics = processor.metrics
+    chunks = int(metrics.counters.get('chunks_printed', 0))
+    lags.sort()
+    return dict(
+        ok=ok,
+        chunks=chunks,
+        requests=int(metrics.counters.get('requests', 0)),
+        connections=model.transport.connections,
+        seconds=round(elapsed, 3),
+        chunks_per_second=round(chunks / elapsed, 1) if elapsed else 0.0,
+        loop_lag_p99_ms=round(1000 * lags[int(0.99 * (len(lags) - 1))], 2) if lags else 0.0,
+        loop_lag_max_ms=round(1000 * lags[-1], 2) if lags else 0.0,
+        peak_rss_mb=round(peak_rss_mb(), 1),
+        stages={name: h.summary() for name, h in sorted(metrics.histograms.items())},
+    )
+
+
+def run_scenario(scenario: Scenario, work_dir: str, tokenizer: str) -> Dict[str, Any]:
+    corpus_dir = prepare_corpus(work_dir, scenario.corpus)
+    with mock_server(scenario.server) as address:
+        command = [
+            sys.executable, os.path.abspath(__file__),
+            '--one', scenario.name,
+            '--address', address,
+            '--corpus-dir', corpus_dir,
+            '--tokenizer', tokenizer,
+        ]
+        completed = subprocess.run(command, stdout=subprocess.PIPE, check=True)
+
+    return json.loads(completed.stdout.decode('utf-8').strip().splitlines()[-1])
+
+
+def find_regressions(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]], tolerance: float) -> List[str]:
+    regressions: List[str] = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+
+        if result['chunks_per_second'] < base['chunks_per_second'] * (1.0 - tolerance):
+            regressions.append(f'{name}: chunks/s {result["chunks_per_second"]} < {base["chunks_per_second"]}')
+
+        if result['peak_rss_mb'] > base['peak_rss_mb'] * (1.0 + tolerance):
+            regressions.append(f'{name}: peak RSS {result["peak_rss_mb"]} MB > {base["peak_rss_mb"]} MB')
+
+    return regressions
+
+
+def print_table(results: Dict[str, Dict[str, Any]]):
+    print(f'{"scenario":<26} {"chunks":>7} {"seconds":>8} {"chunks/s":>9} {"lag p99":>8} {"lag max":>8} {"RSS MB":>7} {"conns":>6}')
+    for name, r in results.items():
+        print(f'{name:<26} {r["chunks"]:>7} {r["seconds"]:>8.2f} {r["chunks_per_second"]:>9.1f} '
+              f'{r["loop_lag_p99_ms"]:>8.2f} {r["loop_lag_max_ms"]:>8.2f} {r["peak_rss_mb"]:>7.1f} {r.get("connections", 0):>6}')
+
+
+def create_argument_parser() -> ArgumentParser:
+    parser = ArgumentParser(description='Benchmark the aigrep pipeline against a mock vLLM server')
+    parser.add_argument('--scenario', '-s', nargs='*', choices=list(SCENARIO_MAP), help='Scenarios to run (all by default)')
+    parser.add_argument('--work-dir', help='Folder to keep the generated corpora in (temporary by default)')
+    parser.add_argument('--tokenizer', default='', help='Tokenizer to use instead of the default of the model')
+    parser.add_argument('--save', metavar='PATH', help='Save the results as JSON')
+    parser.add_argument('--baseline', metavar='PATH', help='Compare the results to those saved earlier')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Relative drop of throughput or growth of memory use tolerated')
+
+    # Internal: running a single scenario in a subprocess
+    parser.add_argument('--one', help=SUPPRESS)
+    parser.add_argument('--address', help=SUPPRESS)
+    parser.add_argument('--corpus-dir', help=SUPPRESS)
+    return parser
+
+
+def main():
+    args = create_argument_parser().parse_args()
+
+    if args.one:
+        result = asyncio.run(run_processor(SCENARIO_MAP[args.one], args.address, args.corpus_dir, args.tokenizer))
+        print(json.dumps(result))
+        return
+
+    scenarios = [SCENARIO_MAP[name] for name in args.scenario] if args.scenario else SCENARIOS
+
+    results: Dict[str, Dict[str, Any]] = {}
+    with contextlib.ExitStack() as stack:
+        work_dir: Optional[str] = args.work_dir
+        if work_dir is None:
+            work_dir = stack.enter_context(tempfile.TemporaryDirectory(prefix='aigrep-bench-'))
+
+        for scenario in scenarios:
+            print(f'Running: {scenario.name} {json.dumps(asdict(scenario.server))}', file=sys.stderr)
+            results[scenario.name] = run_scenario(scenario, work_dir, args.tokenizer)
+
+    print_table(results)
+
+    if args.save:
+        with open(args.save, 'wt', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'rt', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION: {regression}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+    if not all(r['ok'] for r in results.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+""" Benchmarking the startup time of the command line tool
+
+Each command is run several times as a separate process, the median wall time
+is compared to its budget. The heavy modules imported by each command are
+listed as well, the help and the configuration commands must not import any.
+
+Usage: python benchmarks/startup.py [--repeat N] [--save results.json] [--baseline results.json]
+
+Exits with an error if a command is over its budget, imports a heavy module it
+must not or got slower beyond the tolerance relative to the baseline results given.
+
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from dataclasses import dataclass, field
+from typing import List, Dict, Any
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+# Modules too slow to import on every start
+HEAVY_MODULES = ['aiohttp', 'vllm_client', 'tiktoken', 'tokenizers', 'yaml', 'toml', 'sqlite3', 'asyncio']
+
+# Runs the command line tool, then lists the heavy modules imported
+PROBE = '''\
+import json, runpy, sys
+heavy = json.loads(sys.argv[2])
+sys.argv = ['aigrep'] + json.loads(sys.argv[1])
+try:
+    runpy.run_module('aigrep.cli', run_name='__main__')
+except SystemExit:
+    pass
+print(json.dumps([name for name in heavy if name in sys.modules]), file=sys.stderr)
+'''
+
+
+@dataclass
+class Command:
+    name: str
+    argv: List[str]
+
+    # Median wall time allowed in milliseconds, on top of the startup of the bare interpreter
+    budget: float
+
+    # Heavy modules the command may import
+    allowed: List[str] = field(default_factory=list)
+
+
+def create_commands(work_dir: str, tokenizer: str) -> List[Command]:
+    # Configuration with the tokenizer given, so the dry run works offline
+    config_path = os.path.join(work_dir, 'config.toml')
+    with open(config_path, 'wt', encoding='utf-8') as f:
+        f.write(f'[[models]]\nid = "WizardLM/WizardCoder-Python-13B-V1.0"\ntokenizer = "{tokenizer}"\n')
+
+    input_path = os.path.join(work_dir, 'input.txt')
+    with open(input_path, 'wt', encoding='utf-8') as f:
+        f.write('def main():\n    return 0\n')
+
+    missing_config = os.path.join(work_dir, 'missing.toml')
+    return [
+        Command('help', ['-h'], 100),
+        Command('info', ['-c', missing_config, '-i'], 100),
+        Command('info_config', ['-c', config_path, '-i'], 150, ['toml']),
+        Command('dry_run', ['-c', config_path, '--dry', '--no-cache', input_path], 1500, HEAVY_MODULES),
+    ]
+
+
+def run_command(argv: List[str]) -> float:
+    started = time.perf_counter()
+    subprocess.run([sys.executable, '-m', 'aigrep.cli'] + argv, stdout=subprocess.DEVNULL, check=True, cwd=ROOT_DIR)
+    return time.perf_counter() - started
+
+
+def imported_modules(argv: List[str]) -> List[str]:
+    completed = subprocess.run(
+        [sys.executable, '-c', PROBE, json.dumps(argv), json.dumps(HEAVY_MODULES)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True, cwd=ROOT_DIR)
+    return json.loads(completed.stderr.decode('utf-8').strip().splitlines()[-1])
+
+
+def measure(command: Command, repeat: int, bare_ms: float) -> Dict[str, Any]:
+    run_command(command.argv)  # Warm up the file system cache
+    times = [1000 * run_command(command.argv) for _ in range(repeat)]
+    median_ms = statistics.median(times)
+    return dict(
+        median_ms=round(median_ms, 1),
+        min_ms=round(min(times), 1),
+        overhead_ms=round(median_ms - bare_ms, 1),
+        budget_ms=command.budget,
+        heavy_modules=imported_modules(command.argv),
+    )
+
+
+def measure_bare(repeat: int) -> float:
+    times: List[float] = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'], check=True)
+        times.append(1000 * (time.perf_counter() - started))
+    return statistics.median(times)
+
+
+def find_problems(commands: List[Command], results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]], tolerance: float) -> List[str]:
+    problems: List[str] = []
+    for command in commands:
+        result = results[command.name]
+
+        if result['overhead_ms'] > command.budget:
+            problems.append(f'{command.name}: {result["overhead_ms"]} ms over the budget of {command.budget} ms')
+
+        unexpected = [name for name in result['heavy_modules'] if name not in command.allowed]
+        if unexpected:
+            problems.append(f'{command.name}: imports {", ".join(unexpected)}')
+
+        base = baseline.get(command.name)
+        if base is not None and result['overhead_ms'] > base['overhead_ms'] * (1.0 + tolerance):
+            problems.append(f'{command.name}: {result["overhead_ms"]} ms > {base["overhead_ms"]} ms')
+
+    return problems
+
+
+def print_table(results: Dict[str, Dict[str, Any]]):
+    print(f'{"command":<12} {"median":>8} {"min":>8} {"overhead":>9} {"budget":>7}  heavy modules')
+    for name, r in results.items():
+        print(f'{name:<12} {r["median_ms"]:>8.1f} {r["min_ms"]:>8.1f} {r["overhead_ms"]:>9.1f} {r["budget_ms"]:>7.0f}  {" ".join(r["heavy_modules"])}')
+
+
+def create_argument_parser() -> ArgumentParser:
+    parser = ArgumentParser(description='Benchmark the startup time of the aigrep command line tool')
+    parser.add_argument('--repeat', '-r', type=int, default=10, help='Runs of each command')
+    parser.add_argument('--tokenizer', default='', help='Tokenizer of the dry run instead of the default (tiktoken downloads it if not cached)')
+    parser.add_argument('--save', metavar='PATH', help='Save the results as JSON')
+    parser.add_argument('--baseline', metavar='PATH', help='Compare the results to those saved earlier')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Relative growth of the startup time tolerated')
+    return parser
+
+
+def main():
+    args = create_argument_parser().parse_args()
+
+    bare_ms = measure_bare(args.repeat)
+    print(f'Bare interpreter: {bare_ms:.1f} ms', file=sys.stderr)
+
+    with tempfile.TemporaryDirectory(prefix='aigrep-startup-') as work_dir:
+        commands = create_commands(work_dir, args.tokenizer)
+        results: Dict[str, Dict[str, Any]] = {}
+        for command in commands:
+            print(f'Running: {command.name} {" ".join(command.argv)}', file=sys.stderr)
+            results[command.name] = measure(command, args.repeat, bare_ms)
+
+    print_table(results)
+
+    if args.save:
+        with open(args.save, 'wt', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    baseline: Dict[str, Dict[str, Any]] = {}
+    if args.baseline:
+        with open(args.baseline, 'rt', encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    problems = find_problems(commands, results, baseline, args.tolerance)
+    for problem in problems:
+        print(f'REGRESSION: {problem}', file=sys.stderr)
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
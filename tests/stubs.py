@@ -0,0 +1,66 @@
+""" Stubs to run the processor without a server or tokenizer files """
+import re
+from typing import List, Optional
+
+from aigrep.arguments import ArgsNamespace, create_argument_parser
+from aigrep.config import DEFAULT_CONFIG
+from aigrep.model import Model
+from aigrep.processor import Processor
+from aigrep.sink import Sink
+from aigrep.tokenizer import TOKENIZERS, Tokenizer
+
+WORDS = 'test:words'
+CHARACTERS = 'test:characters'
+
+
+class WordTokenizer(Tokenizer):
+    """ Each word with the whitespace following it is a token """
+
+    def encode(self, text: str) -> List[int]:
+        return [len(m.group()) for m in re.finditer(r'\S+\s*|\s+', text)]
+
+    def token_offsets(self, text: str) -> List[int]:
+        return [m.start() for m in re.finditer(r'\S+\s*|\s+', text)]
+
+
+class CharacterTokenizer(Tokenizer):
+    """ Each character is a token """
+
+    def encode(self, text: str) -> List[int]:
+        return [ord(c) for c in text]
+
+    def token_offsets(self, text: str) -> List[int]:
+        return list(range(len(text)))
+
+
+TOKENIZERS[WORDS] = WordTokenizer(WORDS)
+TOKENIZERS[CHARACTERS] = CharacterTokenizer(CHARACTERS)
+
+
+class ListSink(Sink):
+
+    def __init__(self):
+        self.outputs: List[str] = []
+        self.events: List[str] = []
+
+    async def output(self, chunk):
+        self.outputs.append(chunk.output)
+
+    def event(self, event: str, data):
+        self.events.append(event)
+
+
+def create_model(post, model_id: str = '', tokenizer: str = WORDS) -> Model:
+    """ Model sending its requests to the post coroutine instead of a server """
+    cfg = DEFAULT_CONFIG.models[0].clone()
+    cfg.template = cfg.prompt_template
+    cfg.id = model_id or cfg.id
+    cfg.tokenizer = tokenizer
+    model = Model(cfg)
+    model.transport.post = post
+    return model
+
+
+def create_processor(argv: List[str], post, escalation: Optional[List[Model]] = None) -> Processor:
+    args = ArgsNamespace.from_args(create_argument_parser().parse_args(argv))
+    return Processor(args, DEFAULT_CONFIG, create_model(post), escalation, sink=ListSink())
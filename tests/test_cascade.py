@@ -0,0 +1,26 @@
+""" Cascade of models with different tokenizers """
+import asyncio
+from typing import Any, Dict, List
+
+from aigrep.chunker import Source
+
+from stubs import CHARACTERS, create_model, create_processor
+
+
+def test_chunk_too_long_for_the_tokenizer_of_a_later_model():
+    models: List[str] = []
+
+    def server(model_id: str, output: str):
+        async def post(url: str, payload: Dict[str, Any]) -> Any:
+            models.append(model_id)
+            return {'text': [payload['prompt'] + output]}
+        return post
+
+    # Counted by words, the chunk is many times longer by characters
+    text = 'word ' * 50 + '\n'
+    second = create_model(server('second', 'OK'), 'second', CHARACTERS)
+    processor = create_processor(['--chunk', '100', '--regexp', 'OK', '--verbose'], server('first', 'NO'), [second])
+    assert not asyncio.run(processor.process([Source('input', text)]))
+
+    assert models == ['first']
+    assert 'CHUNK_TOO_LONG' in processor.sink.events
@@ -0,0 +1,26 @@
+""" Arguments of the jobs of the daemon """
+import pytest
+
+from aigrep.arguments import create_argument_parser
+from aigrep.daemon import JobArgumentError, JobArgumentParser
+
+
+def test_invalid_arguments_are_raised_for_the_client(capsys):
+    parser = create_argument_parser(JobArgumentParser)
+    with pytest.raises(JobArgumentError) as e:
+        parser.parse_args(['--chunk', 'many'])
+
+    assert e.value.code == 2
+    assert 'usage:' in str(e.value)
+    assert "argument --chunk" in str(e.value)
+    assert capsys.readouterr() == ('', '')
+
+
+def test_help_is_raised_for_the_client(capsys):
+    parser = create_argument_parser(JobArgumentParser)
+    with pytest.raises(JobArgumentError) as e:
+        parser.parse_args(['--help'])
+
+    assert e.value.code == 0
+    assert '--chunk' in str(e.value)
+    assert capsys.readouterr() == ('', '')
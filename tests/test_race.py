@@ -0,0 +1,40 @@
+""" Racing samples (--race) against a stub transport, without a server """
+import asyncio
+from typing import Any, Dict, List
+
+from aigrep.chunker import Source
+
+from stubs import create_processor
+
+
+def test_raced_samples_generate_a_single_sequence():
+    payloads: List[Dict[str, Any]] = []
+
+    async def post(url: str, payload: Dict[str, Any]) -> Any:
+        payloads.append(payload)
+        return {'text': [payload['prompt'] + 'OK'] * payload['n']}
+
+    processor = create_processor(['--race', 'first', '--number', '3', '--regexp', 'OK'], post)
+    assert asyncio.run(processor.process([Source('input', 'Some text\n')]))
+
+    assert processor.sink.outputs == ['OK']
+    assert payloads
+    for payload in payloads:
+        assert payload['n'] == 1
+        assert payload['best_of'] == 1
+
+
+def test_cancelled_samples_are_charged():
+    async def post(url: str, payload: Dict[str, Any]) -> Any:
+        if post.calls:
+            await asyncio.sleep(10)
+        post.calls += 1
+        return {'text': [payload['prompt'] + 'OK']}
+
+    post.calls = 0
+    processor = create_processor(['--race', 'first', '--number', '3', '--regexp', 'OK', '--max-tokens', '100'], post)
+    assert asyncio.run(processor.process([Source('input', 'Some text\n')]))
+
+    # The two losing samples were sent, then cancelled
+    assert processor.budget.spent >= 2 * 100
+    assert processor.budget.reserved == 0